@@ -2,43 +2,46 @@
 KusiDilve SaaS - FastAPI Backend
 Limpieza DILVE → WooCommerce Sync
 """
-from fastapi import FastAPI, Depends, HTTPException, UploadFile, File, BackgroundTasks
-from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
-from fastapi.staticfiles import StaticFiles
+from anyio import from_thread
+from fastapi import FastAPI, Depends, HTTPException, UploadFile, File, BackgroundTasks, Request
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import case, func, insert, update
 from sqlalchemy.orm import Session
-from datetime import datetime, timedelta
+from datetime import datetime
+from cachetools import TTLCache
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+import aiofiles
 import csv
+import hashlib
 import io
 import logging
 import os
-from typing import List, Optional
+import tempfile
+import threading
+from typing import Dict, List
 import asyncio
 
 # Imports locales
-from database import get_db, engine, Base, Library, Book, SyncLog, StripeSubscription
-from models import (
-    LibraryCreate, LibraryResponse, DashboardMetrics, SyncRequest, SyncResponse,
-    BookResponse, PricingPlan, ExportRequest
-)
+from database import get_db, init_db, engine, Library, Book, SyncLog, UPSERT_DIALECTS, bulk_upsert_books
+from models import LibraryCreate, LibraryResponse, SyncRequest, CSVMappingUpdate
 from csv_cleaner import CSVCleaner
 from dilve_client import DilveClient, DilveSync
 from woocommerce_sync import WooCommerceClient, WooCommerceSync
-from mapping_utils import normalize_header, suggest_mapping
 import json
 
 # Setup logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Create tables
-Base.metadata.create_all(bind=engine)
-
 # FastAPI app
 app = FastAPI(
     title="KusiDilve SaaS",
     description="Limpieza DILVE → WooCommerce Sync para librerías españolas",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse
 )
 
 # CORS
@@ -54,6 +57,84 @@ app.add_middleware(
 os.makedirs("templates", exist_ok=True)
 os.makedirs("data", exist_ok=True)
 
+# Crea tablas al arrancar (no al importar); INIT_DB=0 lo omite en workers de producción
+@app.on_event("startup")
+def _init_schema():
+    if os.getenv("INIT_DB", "1") == "1":
+        init_db()
+
+
+# Pool de procesos para parsear y limpiar CSV subidos fuera del event loop
+PARSE_POOL = ProcessPoolExecutor(max_workers=os.cpu_count())
+
+
+@app.on_event("shutdown")
+def _shutdown_parse_pool():
+    PARSE_POOL.shutdown(wait=False, cancel_futures=True)
+
+
+# Clientes DILVE/WooCommerce reutilizados entre peticiones (conexiones keep-alive),
+# uno por librería: {(tipo, library_id): (credenciales, cliente)}. Se cierran al apagar
+api_clients: Dict[tuple, tuple] = {}
+# Syncs en curso por cliente; uno sustituido por nuevas credenciales se cierra
+# en cuanto termina su último sync
+api_client_users: Counter = Counter()
+retired_api_clients: set = set()
+api_clients_lock = threading.Lock()
+
+
+def _library_client(key: tuple, credentials: tuple, factory):
+    """Cliente de la librería con un uso reservado; liberarlo con _release_client"""
+    stale = None
+    with api_clients_lock:
+        entry = api_clients.get(key)
+        if entry is None or entry[0] != credentials:
+            if entry is not None:
+                if api_client_users[entry[1]]:
+                    retired_api_clients.add(entry[1])
+                else:
+                    stale = entry[1]
+            entry = api_clients[key] = (credentials, factory(*credentials))
+        api_client_users[entry[1]] += 1
+    if stale is not None:
+        # Rutas síncronas: corren en el threadpool de anyio, el cierre vuelve al event loop
+        from_thread.run(stale.aclose)
+    return entry[1]
+
+
+async def _release_client(client):
+    """Libera un uso del cliente y lo cierra si ya fue sustituido"""
+    with api_clients_lock:
+        api_client_users[client] -= 1
+        if api_client_users[client] > 0:
+            return
+        del api_client_users[client]
+        if client not in retired_api_clients:
+            return
+        retired_api_clients.discard(client)
+    await client.aclose()
+
+
+def _dilve_client(library_id: int, user: str, password: str) -> DilveClient:
+    return _library_client(("dilve", library_id), (user, password), DilveClient)
+
+
+def _woocommerce_client(library_id: int, url: str, consumer_key: str, consumer_secret: str) -> WooCommerceClient:
+    return _library_client(
+        ("woocommerce", library_id), (url, consumer_key, consumer_secret), WooCommerceClient
+    )
+
+
+@app.on_event("shutdown")
+async def _close_api_clients():
+    with api_clients_lock:
+        clients = [client for _, client in api_clients.values()] + list(retired_api_clients)
+        api_clients.clear()
+        retired_api_clients.clear()
+        api_client_users.clear()
+    for client in clients:
+        await client.aclose()
+
 
 # ============================================================================
 # RUTAS PÚBLICAS
@@ -65,10 +146,9 @@ async def root():
     return {"message": "KusiDilve SaaS API", "docs": "/docs"}
 
 
-@app.get("/pricing")
-async def get_pricing():
-    """Obtiene planes de precios"""
-    plans = [
+# Planes estáticos: se serializan una sola vez al importar el módulo
+PRICING_PAYLOAD = {
+    "plans": [
         {
             "name": "Básico",
             "price": 9.0,
@@ -106,7 +186,17 @@ async def get_pricing():
             "stripe_price_id": "price_premium_monthly"
         }
     ]
-    return {"plans": plans}
+}
+PRICING_ETAG = '"' + hashlib.md5(json.dumps(PRICING_PAYLOAD).encode()).hexdigest() + '"'
+
+
+@app.get("/pricing")
+async def get_pricing(request: Request):
+    """Obtiene planes de precios"""
+    headers = {"ETag": PRICING_ETAG, "Cache-Control": "public, max-age=3600"}
+    if request.headers.get("if-none-match") == PRICING_ETAG:
+        return Response(status_code=304, headers=headers)
+    return ORJSONResponse(PRICING_PAYLOAD, headers=headers)
 
 
 # ============================================================================
@@ -114,7 +204,7 @@ async def get_pricing():
 # ============================================================================
 
 @app.post("/api/libraries", response_model=LibraryResponse)
-async def create_library(library: LibraryCreate, db: Session = Depends(get_db)):
+def create_library(library: LibraryCreate, db: Session = Depends(get_db)):
     """Crea nueva librería"""
     try:
         # Verifica que no exista
@@ -147,7 +237,7 @@ async def create_library(library: LibraryCreate, db: Session = Depends(get_db)):
 
 
 @app.get("/api/libraries/{library_id}", response_model=LibraryResponse)
-async def get_library(library_id: int, db: Session = Depends(get_db)):
+def get_library(library_id: int, db: Session = Depends(get_db)):
     """Obtiene librería por ID"""
     library = db.query(Library).filter(Library.id == library_id).first()
     if not library:
@@ -159,42 +249,62 @@ async def get_library(library_id: int, db: Session = Depends(get_db)):
 # DASHBOARD & MÉTRICAS
 # ============================================================================
 
+# Métricas por librería; se invalidan al terminar una sync DILVE o un upload
+dashboard_cache = TTLCache(maxsize=1024, ttl=30)
+dashboard_cache_lock = threading.Lock()
+
+
+def _invalidate_dashboard(library_id: int):
+    with dashboard_cache_lock:
+        dashboard_cache.pop(library_id, None)
+
+
 @app.get("/api/dashboard/{library_id}")
-async def get_dashboard(library_id: int, db: Session = Depends(get_db)):
-    """Obtiene métricas del dashboard"""
+def get_dashboard(library_id: int, db: Session = Depends(get_db)):
+    """Obtiene métricas del dashboard (cacheadas 30 s)"""
+    with dashboard_cache_lock:
+        cached = dashboard_cache.get(library_id)
+    if cached is not None:
+        return cached
+
     try:
-        library = db.query(Library).filter(Library.id == library_id).first()
-        if not library:
+        # Librería + métricas en una sola consulta agregada (LEFT JOIN a libros)
+        metrics = db.query(
+            Library.plan,
+            Library.last_sync,
+            func.count(Book.id).label("total"),
+            func.sum(case((Book.stock > 0, 1), else_=0)).label("active"),
+            func.sum(case((Book.is_dirty == True, 1), else_=0)).label("dirty"),
+            func.avg(Book.score_seo).label("seo")
+        ).outerjoin(
+            Book, Book.library_id == Library.id
+        ).filter(
+            Library.id == library_id
+        ).group_by(Library.id).one_or_none()
+        if metrics is None:
             raise HTTPException(status_code=404, detail="Librería no encontrada")
 
-        # Calcula métricas
-        total_books = db.query(Book).filter(Book.library_id == library_id).count()
-        active_books = db.query(Book).filter(
-            Book.library_id == library_id,
-            Book.stock > 0
-        ).count()
+        total_books = metrics.total
+        active_books = metrics.active or 0
         out_of_stock = total_books - active_books
-        dirty_count = db.query(Book).filter(
-            Book.library_id == library_id,
-            Book.is_dirty == True
-        ).count()
+        dirty_count = metrics.dirty or 0
         clean_count = total_books - dirty_count
+        avg_seo = metrics.seo or 0
 
-        # SEO score promedio
-        books = db.query(Book).filter(Book.library_id == library_id).all()
-        avg_seo = sum(b.score_seo for b in books) / len(books) if books else 0
-
-        return {
+        dashboard = {
             "total_books": total_books,
             "active_books": active_books,
             "out_of_stock": out_of_stock,
             "dirty_count": dirty_count,
             "clean_count": clean_count,
             "seo_score": round(avg_seo, 1),
-            "last_sync": library.last_sync,
-            "plan": library.plan,
+            "last_sync": metrics.last_sync,
+            "plan": metrics.plan,
             "percentage_clean": round((clean_count / total_books * 100) if total_books > 0 else 0, 1)
         }
+        with dashboard_cache_lock:
+            dashboard_cache[library_id] = dashboard
+        return dashboard
 
     except Exception as e:
         logger.error(f"Error getting dashboard: {e}")
@@ -206,7 +316,7 @@ async def get_dashboard(library_id: int, db: Session = Depends(get_db)):
 # ============================================================================
 
 @app.post("/api/sync/dilve/{library_id}")
-async def sync_dilve(
+def sync_dilve(
     library_id: int,
     request: SyncRequest,
     background_tasks: BackgroundTasks,
@@ -218,8 +328,8 @@ async def sync_dilve(
         if not library:
             raise HTTPException(status_code=404, detail="Librería no encontrada")
 
-        # Crea cliente DILVE
-        dilve_client = DilveClient(library.dilve_user, library.dilve_password)
+        # Cliente DILVE reutilizado por credenciales
+        dilve_client = _dilve_client(library.id, library.dilve_user, library.dilve_password)
         dilve_sync = DilveSync(dilve_client)
 
         # Sincroniza en background
@@ -257,70 +367,127 @@ async def _sync_dilve_background(library_id: int, dilve_sync: DilveSync, from_da
         records = result.get("records", [])
         logger.info(f"DILVE sync: {len(records)} registros")
 
-        # Limpia registros
-        cleaned_records, error_count = CSVCleaner.clean_csv(records)
-
-        # Guarda en BD
-        for cleaned in cleaned_records:
-            existing = db.query(Book).filter(
-                Book.library_id == library_id,
-                Book.isbn13 == cleaned["isbn13"]
-            ).first()
-
-            if existing:
-                existing.title = cleaned["title"]
-                existing.author = cleaned["author"]
-                existing.description = cleaned["description"]
-                existing.description_clean = cleaned["description_clean"]
-                existing.price = cleaned["price"]
-                existing.stock = cleaned["stock"]
-                existing.stock_status = cleaned["stock_status"]
-                existing.seo_title = cleaned["seo_title"]
-                existing.slug = cleaned["slug"]
-                existing.score_seo = cleaned["score_seo"]
-                existing.is_dirty = False
-                existing.sync_date = datetime.utcnow()
-            else:
-                book = Book(
-                    library_id=library_id,
-                    isbn13=cleaned["isbn13"],
-                    title=cleaned["title"],
-                    author=cleaned["author"],
-                    description=cleaned["description"],
-                    description_clean=cleaned["description_clean"],
-                    price=cleaned["price"],
-                    stock=cleaned["stock"],
-                    stock_status=cleaned["stock_status"],
-                    seo_title=cleaned["seo_title"],
-                    slug=cleaned["slug"],
-                    score_seo=cleaned["score_seo"],
-                    is_dirty=False,
-                    sync_date=datetime.utcnow()
-                )
-                db.add(book)
-
-        # Actualiza librería
-        library = db.query(Library).filter(Library.id == library_id).first()
-        library.books_count = len(cleaned_records)
-        library.last_sync = datetime.utcnow()
-
-        # Registra sync log
-        duration = (datetime.utcnow() - start_time).total_seconds()
-        sync_log = SyncLog(
-            library_id=library_id,
-            processed=len(records),
-            cleaned=len(cleaned_records),
-            errors=error_count,
-            duration_seconds=duration,
-            status="success"
+        # Limpieza y escritura en BD (bloqueantes) fuera del event loop
+        cleaned_count, error_count = await run_in_threadpool(
+            _store_dilve_records, db, library_id, records, start_time
         )
-        db.add(sync_log)
-        db.commit()
 
-        logger.info(f"DILVE sync completed: {len(cleaned_records)} cleaned, {error_count} errors")
+        logger.info(f"DILVE sync completed: {cleaned_count} cleaned, {error_count} errors")
 
     except Exception as e:
         logger.error(f"Background sync error: {e}")
+    finally:
+        await _release_client(dilve_sync.client)
+
+
+def _split_existing_books(db: Session, library_id: int, rows_by_isbn: Dict[str, dict]):
+    """Separa altas de actualizaciones con un solo SELECT (índice library_id + isbn13)"""
+    existing_ids = dict(
+        db.query(Book.isbn13, Book.id).filter(
+            Book.library_id == library_id,
+            Book.isbn13.in_(list(rows_by_isbn))
+        ).all()
+    )
+
+    new_rows = []
+    updated_rows = []
+    for isbn, row in rows_by_isbn.items():
+        if isbn in existing_ids:
+            updated_rows.append({"id": existing_ids[isbn], **row})
+        else:
+            new_rows.append(row)
+    return new_rows, updated_rows
+
+
+DILVE_BATCH_SIZE = 5000
+
+# Por encima de este tamaño el sync DILVE carga las altas con COPY en PostgreSQL
+DILVE_COPY_THRESHOLD = 5000
+
+
+def _store_dilve_records(db: Session, library_id: int, records: List[dict], start_time: datetime):
+    """Limpia registros DILVE y los guarda en BD. Retorna (cleaned, errors)"""
+    # Limpia registros (lotes repartidos en el pool de procesos)
+    cleaned_records, error_count = CSVCleaner.clean_csv(records, executor=PARSE_POOL)
+
+    # Guarda en BD por lotes: upsert por (library_id, isbn13), o un SELECT por lote
+    # que separa altas de actualizaciones en otros motores
+    now = datetime.utcnow()
+    rows_by_isbn = {
+        cleaned["isbn13"]: {
+            "library_id": library_id,
+            "isbn13": cleaned["isbn13"],
+            "title": cleaned["title"],
+            "author": cleaned["author"],
+            "description": cleaned["description"],
+            "description_clean": cleaned["description_clean"],
+            "price": cleaned["price"],
+            "stock": cleaned["stock"],
+            "stock_status": cleaned["stock_status"],
+            "seo_title": cleaned["seo_title"],
+            "slug": cleaned["slug"],
+            "score_seo": cleaned["score_seo"],
+            "is_dirty": False,
+            "sync_date": now
+        }
+        for cleaned in cleaned_records
+    }
+
+    # Cada lote se confirma por separado: un fallo solo descarta ese lote
+    isbns = list(rows_by_isbn)
+    failed_count = 0
+    copy_new = engine.dialect.name == "postgresql" and len(isbns) > DILVE_COPY_THRESHOLD
+    for start in range(0, len(isbns), DILVE_BATCH_SIZE):
+        batch = {isbn: rows_by_isbn[isbn] for isbn in isbns[start:start + DILVE_BATCH_SIZE]}
+        try:
+            if copy_new:
+                # Catálogo grande en PostgreSQL: COPY para las altas, UPDATE para el resto
+                new_rows, updated_rows = _split_existing_books(db, library_id, batch)
+                if new_rows:
+                    new_rows = [{**row, "created_at": now, "updated_at": now} for row in new_rows]
+                    _copy_books(db, new_rows, tuple(new_rows[0]))
+                if updated_rows:
+                    db.execute(update(Book), updated_rows)
+            elif engine.dialect.name in UPSERT_DIALECTS:
+                # INSERT ... ON CONFLICT (library_id, isbn13) DO UPDATE
+                bulk_upsert_books(db, batch.values())
+            else:
+                new_rows, updated_rows = _split_existing_books(db, library_id, batch)
+
+                # executemany en lote (insertmanyvalues / UPDATE por clave primaria)
+                if new_rows:
+                    db.execute(insert(Book), new_rows)
+                if updated_rows:
+                    db.execute(update(Book), updated_rows)
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            failed_count += len(batch)
+            logger.error(f"DILVE batch at {start} failed: {e}")
+    error_count += failed_count
+
+    # Actualiza librería con un UPDATE directo (sin cargar el objeto en la sesión)
+    db.execute(
+        update(Library)
+        .where(Library.id == library_id)
+        .values(books_count=len(cleaned_records), last_sync=datetime.utcnow())
+    )
+
+    # Registra sync log
+    duration = (datetime.utcnow() - start_time).total_seconds()
+    sync_log = SyncLog(
+        library_id=library_id,
+        processed=len(records),
+        cleaned=len(cleaned_records),
+        errors=error_count,
+        duration_seconds=duration,
+        status="success" if not failed_count else "partial"
+    )
+    db.add(sync_log)
+    db.commit()
+    _invalidate_dashboard(library_id)
+
+    return len(cleaned_records), error_count
 
 
 # ============================================================================
@@ -328,7 +495,7 @@ async def _sync_dilve_background(library_id: int, dilve_sync: DilveSync, from_da
 # ============================================================================
 
 @app.post("/api/sync/woocommerce/{library_id}")
-async def sync_woocommerce(
+def sync_woocommerce(
     library_id: int,
     background_tasks: BackgroundTasks,
     db: Session = Depends(get_db)
@@ -343,8 +510,9 @@ async def sync_woocommerce(
         if library.plan == "basic":
             raise HTTPException(status_code=403, detail="Plan Básico no incluye sync WooCommerce")
 
-        # Crea cliente WooCommerce
-        wc_client = WooCommerceClient(
+        # Cliente WooCommerce reutilizado por tienda
+        wc_client = _woocommerce_client(
+            library.id,
             library.woocommerce_url,
             library.woocommerce_key,
             library.woocommerce_secret
@@ -369,35 +537,47 @@ async def sync_woocommerce(
         raise HTTPException(status_code=500, detail=str(e))
 
 
+def _load_woocommerce_books(db: Session, library_id: int) -> List[dict]:
+    """Libros limpios listos para WooCommerce (solo las columnas necesarias)"""
+    rows = db.query(
+        Book.isbn13, Book.title, Book.author, Book.description_clean, Book.price,
+        Book.stock, Book.stock_status, Book.seo_title, Book.slug, Book.score_seo
+    ).filter(
+        Book.library_id == library_id,
+        Book.is_dirty == False
+    ).yield_per(1000)
+
+    return [
+        {
+            "isbn13": b.isbn13,
+            "sku": f"LIB-{b.isbn13[-6:]}",
+            "title": b.title,
+            "author": b.author,
+            "description_clean": b.description_clean,
+            "price": b.price,
+            "stock": b.stock,
+            "stock_status": b.stock_status,
+            "seo_title": b.seo_title,
+            "slug": b.slug,
+            "score_seo": b.score_seo,
+            "categories": "Ficción"
+        }
+        for b in rows
+    ]
+
+
+def _save_sync_log(db: Session, sync_log: SyncLog):
+    db.add(sync_log)
+    db.commit()
+
+
 async def _sync_woocommerce_background(library_id: int, wc_client: WooCommerceClient, db: Session):
     """Sincronización WooCommerce en background"""
     try:
         start_time = datetime.utcnow()
 
         # Obtiene libros limpios
-        books = db.query(Book).filter(
-            Book.library_id == library_id,
-            Book.is_dirty == False
-        ).all()
-
-        books_data = [
-            {
-                "isbn13": b.isbn13,
-                "sku": f"LIB-{b.isbn13[-6:]}",
-                "title": b.title,
-                "author": b.author,
-                "description": b.description,
-                "description_clean": b.description_clean,
-                "price": b.price,
-                "stock": b.stock,
-                "stock_status": b.stock_status,
-                "seo_title": b.seo_title,
-                "slug": b.slug,
-                "score_seo": b.score_seo,
-                "categories": "Ficción"
-            }
-            for b in books
-        ]
+        books_data = await run_in_threadpool(_load_woocommerce_books, db, library_id)
 
         # Sincroniza
         wc_sync = WooCommerceSync(wc_client)
@@ -411,69 +591,90 @@ async def _sync_woocommerce_background(library_id: int, wc_client: WooCommerceCl
             cleaned=result.get("created", 0) + result.get("updated", 0),
             errors=result.get("errors", 0),
             duration_seconds=duration,
-            status="success" if result.get("status") == "success" else "partial"
+            status=result.get("status", "partial"),
+            error_message=result.get("message")
         )
-        db.add(sync_log)
-        db.commit()
+        await run_in_threadpool(_save_sync_log, db, sync_log)
 
         logger.info(f"WooCommerce sync completed: {result}")
 
     except Exception as e:
         logger.error(f"Background WooCommerce sync error: {e}")
+    finally:
+        await _release_client(wc_client)
 
 
 # ============================================================================
 # EXPORTAR CSV
 # ============================================================================
 
+def _csv_stream(headers: List[str], rows, flush_size: int = 64 * 1024):
+    """Genera el CSV por bloques de ~64 KiB para StreamingResponse"""
+    buf = io.StringIO()
+    writer = csv.writer(buf, lineterminator="\n")
+    writer.writerow(headers)
+
+    for row in rows:
+        writer.writerow(row)
+        if buf.tell() >= flush_size:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+
+    if buf.tell():
+        yield buf.getvalue()
+
+
 @app.get("/api/export/woocommerce/{library_id}")
-async def export_woocommerce_csv(library_id: int, db: Session = Depends(get_db)):
+def export_woocommerce_csv(library_id: int, db: Session = Depends(get_db)):
     """Exporta CSV en formato WooCommerce"""
     try:
-        books = db.query(Book).filter(
+        query = db.query(
+            Book.isbn13, Book.title, Book.author, Book.publisher, Book.collection,
+            Book.publication_year, Book.language, Book.price, Book.sale_price, Book.stock,
+            Book.stock_status, Book.description_clean, Book.post_excerpt, Book.slug,
+            Book.seo_title, Book.seo_description, Book.focus_keyword, Book.category_main,
+            Book.category_sub, Book.tags, Book.image_url, Book.image_alt, Book.image_title
+        ).filter(
             Book.library_id == library_id,
             Book.is_dirty == False
-        ).all()
+        )
 
-        if not books:
+        if not query.with_entities(Book.id).first():
             raise HTTPException(status_code=404, detail="No hay libros limpios para exportar")
 
-        books_data = [
-            {
-                "isbn13": b.isbn13,
-                "sku": f"LIB-{b.isbn13[-6:]}" if b.isbn13 else "LIB-000000",
-                "post_title": b.title,
-                "author": b.author,
-                "publisher": b.publisher,
-                "collection": b.collection,
-                "publication_year": b.publication_year,
-                "language": b.language,
-                "regular_price": b.price,
-                "sale_price": b.sale_price,
-                "stock": b.stock,
-                "stock_status": b.stock_status,
-                "post_content": b.description_clean,
-                "post_excerpt": b.post_excerpt,
-                "post_name": b.slug,
-                "seo_title": b.seo_title,
-                "seo_description": b.seo_description,
-                "focus_keyword": b.focus_keyword,
-                "category_main": b.category_main,
-                "category_sub": b.category_sub,
-                "tags": b.tags,
-                "image_url": b.image_url,
-                "image_alt": b.image_alt,
-                "image_title": b.image_title
-            }
-            for b in books
-        ]
-
-        # Genera CSV
-        csv_content = CSVCleaner.to_woocommerce_csv(books_data)
-
-        # Retorna como descarga
+        def rows():
+            for b in query.yield_per(1000):
+                yield CSVCleaner.woocommerce_values({
+                    "isbn13": b.isbn13,
+                    "sku": f"LIB-{b.isbn13[-6:]}" if b.isbn13 else "LIB-000000",
+                    "post_title": b.title,
+                    "author": b.author,
+                    "publisher": b.publisher,
+                    "collection": b.collection,
+                    "publication_year": b.publication_year,
+                    "language": b.language,
+                    "regular_price": b.price,
+                    "sale_price": b.sale_price,
+                    "stock": b.stock,
+                    "stock_status": b.stock_status,
+                    "post_content": b.description_clean,
+                    "post_excerpt": b.post_excerpt,
+                    "post_name": b.slug,
+                    "seo_title": b.seo_title,
+                    "seo_description": b.seo_description,
+                    "focus_keyword": b.focus_keyword,
+                    "category_main": b.category_main,
+                    "category_sub": b.category_sub,
+                    "tags": b.tags,
+                    "image_url": b.image_url,
+                    "image_alt": b.image_alt,
+                    "image_title": b.image_title
+                })
+
+        # Retorna como descarga, generando el CSV a medida que se lee
         return StreamingResponse(
-            iter([csv_content]),
+            _csv_stream(list(CSVCleaner.WC_MAPPING.keys()), rows()),
             media_type="text/csv",
             headers={"Content-Disposition": "attachment; filename=woocommerce_export.csv"}
         )
@@ -484,38 +685,39 @@ async def export_woocommerce_csv(library_id: int, db: Session = Depends(get_db))
 
 
 @app.get("/api/export/wp-all-import/{library_id}")
-async def export_wp_all_import_csv(library_id: int, db: Session = Depends(get_db)):
+def export_wp_all_import_csv(library_id: int, db: Session = Depends(get_db)):
     """Exporta CSV en formato WP All Import (drag&drop Step 4)"""
     try:
-        from csv_wpallimport import WPAllImportConverter
+        from csv_wpallimport import WPAllImportConverter, WP_ALL_IMPORT_FIELDS
 
-        books = db.query(Book).filter(
+        query = db.query(
+            Book.isbn13, Book.title, Book.author, Book.description_clean, Book.price, Book.stock
+        ).filter(
             Book.library_id == library_id,
             Book.is_dirty == False
-        ).all()
+        )
 
-        if not books:
+        if not query.with_entities(Book.id).first():
             raise HTTPException(status_code=404, detail="No hay libros limpios para exportar")
 
-        books_data = [
-            {
-                "isbn13": b.isbn13,
-                "titulo": b.title,
-                "autor": b.author,
-                "resumen": b.description_clean,
-                "precio": str(b.price),
-                "stock": str(b.stock),
-                "materia_ibic": "Ficción"
-            }
-            for b in books
-        ]
-
-        # Convierte a WP All Import
-        csv_content = WPAllImportConverter.to_wp_all_import_csv(books_data)
-
-        # Retorna como descarga
+        def rows():
+            for b in query.yield_per(1000):
+                # Convierte a WP All Import
+                wp_values = WPAllImportConverter.dilve_to_wp_all_import_values({
+                    "isbn13": b.isbn13,
+                    "titulo": b.title,
+                    "autor": b.author,
+                    "resumen": b.description_clean,
+                    "precio": str(b.price),
+                    "stock": str(b.stock),
+                    "materia_ibic": "Ficción"
+                })
+                if wp_values:
+                    yield wp_values
+
+        # Retorna como descarga, generando el CSV a medida que se lee
         return StreamingResponse(
-            iter([csv_content]),
+            _csv_stream(WP_ALL_IMPORT_FIELDS, rows()),
             media_type="text/csv",
             headers={"Content-Disposition": "attachment; filename=wp_all_import_ready.csv"}
         )
@@ -529,8 +731,91 @@ async def export_wp_all_import_csv(library_id: int, db: Session = Depends(get_db
 # UPLOAD CSV
 # ============================================================================
 
+# A partir de este tamaño la carga inicial usa COPY en PostgreSQL
+COPY_THRESHOLD = 100
+
+BOOK_COPY_COLUMNS = (
+    "library_id", "isbn13", "title", "author", "description", "description_clean",
+    "price", "stock", "stock_status", "seo_title", "slug", "score_seo",
+    "category_main", "image_url", "is_dirty", "sync_date", "created_at", "updated_at"
+)
+
+
+def _copy_books(db: Session, book_rows: List[dict], columns: tuple = BOOK_COPY_COLUMNS):
+    """Carga masiva de libros con COPY ... FROM STDIN (solo PostgreSQL)"""
+    buf = io.StringIO()
+    writer = csv.writer(buf, quoting=csv.QUOTE_MINIMAL)
+    for row in book_rows:
+        writer.writerow([
+            "\\N" if row[column] is None else row[column]
+            for column in columns
+        ])
+    buf.seek(0)
+
+    # Conexión DBAPI (psycopg2) de la transacción actual de la sesión
+    cursor = db.connection().connection.cursor()
+    try:
+        cursor.copy_expert(
+            f"COPY {Book.__tablename__} ({', '.join(columns)}) "
+            "FROM STDIN WITH (FORMAT csv, NULL '\\N')",
+            buf
+        )
+    finally:
+        cursor.close()
+
+
+def _store_uploaded_books(db: Session, library: Library, cleaned_rows: List[dict]):
+    """Guarda las filas limpias de un CSV subido (alta o actualización por ISBN)"""
+    now = datetime.utcnow()
+    # Un libro por ISBN: (library_id, isbn13) es único
+    rows_by_isbn = {
+        cleaned.get("isbn13"): {
+            "library_id": library.id,
+            "isbn13": cleaned.get("isbn13"),
+            "title": cleaned.get("title", ""),
+            "author": cleaned.get("author", ""),
+            "description": cleaned.get("description", ""),
+            "description_clean": cleaned.get("description_clean", ""),
+            "price": cleaned.get("price", 0.0),
+            "stock": cleaned.get("stock", 0),
+            "stock_status": cleaned.get("stock_status", "out_of_stock"),
+            "seo_title": cleaned.get("seo_title", ""),
+            "slug": cleaned.get("slug", ""),
+            "score_seo": cleaned.get("score_seo", 0),
+            "category_main": cleaned.get("categories", "Sin Categoría"),
+            "image_url": cleaned.get("images", ""),
+            "is_dirty": False,
+            "sync_date": now,
+            "created_at": now,
+            "updated_at": now
+        }
+        for cleaned in cleaned_rows
+    }
+    dialect = engine.dialect.name
+    if dialect in UPSERT_DIALECTS and not (dialect == "postgresql" and len(rows_by_isbn) > COPY_THRESHOLD):
+        # INSERT ... ON CONFLICT (library_id, isbn13) DO UPDATE, sin SELECT previo
+        bulk_upsert_books(db, rows_by_isbn.values())
+    else:
+        # Cargas grandes en PostgreSQL: COPY para las altas, UPDATE para el resto
+        new_rows, updated_rows = _split_existing_books(db, library.id, rows_by_isbn)
+        for row in updated_rows:
+            row.pop("created_at")
+
+        if dialect == "postgresql" and len(new_rows) > COPY_THRESHOLD:
+            _copy_books(db, new_rows)
+        elif new_rows:
+            db.execute(insert(Book), new_rows)
+        if updated_rows:
+            db.execute(update(Book), updated_rows)
+
+    library.books_count = len(cleaned_rows)
+    library.last_sync = datetime.utcnow()
+    db.commit()
+    _invalidate_dashboard(library.id)
+
+
 @app.post("/api/libraries/{library_id}/csv-mapping")
-async def update_csv_mapping(
+def update_csv_mapping(
     library_id: int,
     mapping_data: CSVMappingUpdate,
     db: Session = Depends(get_db)
@@ -540,10 +825,20 @@ async def update_csv_mapping(
     if not library:
         raise HTTPException(status_code=404, detail="Librería no encontrada")
     
-    library.csv_mapping = json.dumps(mapping_data.mapping)
+    library.csv_mapping = mapping_data.mapping
     db.commit()
     return {"status": "success", "message": "Mapping actualizado"}
 
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+async def _spool_upload(file: UploadFile, path: str):
+    """Vuelca el CSV subido a disco por bloques, sin cargarlo entero en memoria"""
+    async with aiofiles.open(path, "wb") as out:
+        while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+            await out.write(chunk)
+
+
 @app.post("/api/upload/csv/{library_id}")
 async def upload_csv(
     library_id: int,
@@ -552,76 +847,49 @@ async def upload_csv(
 ):
     """Sube y procesa CSV con soporte para Mapping Personalizado"""
     try:
-        library = db.query(Library).filter(Library.id == library_id).first()
+        library = await run_in_threadpool(
+            db.query(Library).filter(Library.id == library_id).first
+        )
         if not library:
             raise HTTPException(status_code=404, detail="Librería no encontrada")
 
-        content = await file.read()
-        csv_text = content.decode('utf-8', errors='ignore')
+        # Mapping guardado; si no hay, el worker sugiere uno a partir de las cabeceras
+        saved_mapping = library.csv_mapping or None
 
-        reader = csv.DictReader(io.StringIO(csv_text))
-        headers = reader.fieldnames
-        rows = list(reader)
+        # El worker lee el fichero temporal: no se serializa el CSV entre procesos
+        fd, upload_path = tempfile.mkstemp(suffix=".csv")
+        os.close(fd)
+        try:
+            await _spool_upload(file, upload_path)
 
-        if not headers:
+            # Parseo + limpieza (CPU-bound) en un proceso aparte: no bloquea el event loop
+            loop = asyncio.get_running_loop()
+            parsed = await loop.run_in_executor(
+                PARSE_POOL, CSVCleaner.process_upload_file, upload_path, saved_mapping
+            )
+        finally:
+            os.remove(upload_path)
+
+        if not parsed["headers"]:
             raise HTTPException(status_code=400, detail="CSV sin cabeceras")
 
-        # Recuperar o sugerir mapping
-        current_mapping = {}
-        if library.csv_mapping:
-            current_mapping = json.loads(library.csv_mapping)
-        else:
-            current_mapping = suggest_mapping(headers)
-            # No lo guardamos automáticamente, el usuario debe confirmarlo
-
-        # Re-mapear filas al estándar KusiDilve
-        remapped_rows = []
-        for row in rows:
-            remapped = {}
-            for kusi_field, user_header in current_mapping.items():
-                remapped[kusi_field] = row.get(user_header, "")
-            remapped_rows.append(remapped)
-
-        # Limpia con el pipeline existente
-        cleaned_rows, error_count = CSVCleaner.clean_csv(remapped_rows)
-
-        # Guarda en BD
-        for cleaned in cleaned_rows:
-            book = Book(
-                library_id=library_id,
-                isbn13=cleaned.get("isbn13"),
-                sku=cleaned.get("sku"),
-                title=cleaned.get("title", ""),
-                author=cleaned.get("author", ""),
-                description=cleaned.get("description", ""),
-                description_clean=cleaned.get("description_clean", ""),
-                price=cleaned.get("price", 0.0),
-                stock=cleaned.get("stock", 0),
-                stock_status=cleaned.get("stock_status", "out_of_stock"),
-                seo_title=cleaned.get("seo_title", ""),
-                slug=cleaned.get("slug", ""),
-                score_seo=cleaned.get("score_seo", 0),
-                category_main=cleaned.get("categories", "Sin Categoría"),
-                image_url=cleaned.get("images", ""),
-                is_dirty=False,
-                sync_date=datetime.utcnow()
-            )
-            db.add(book)
+        current_mapping = parsed["mapping"]
+        cleaned_rows = parsed["cleaned_rows"]
+        error_count = parsed["errors"]
 
-        library.books_count = len(cleaned_rows)
-        library.last_sync = datetime.utcnow()
-        db.commit()
+        # Guarda en BD (bloqueante) fuera del event loop
+        await run_in_threadpool(_store_uploaded_books, db, library, cleaned_rows)
 
         return {
             "status": "success",
-            "processed": len(rows),
+            "processed": parsed["processed"],
             "cleaned": len(cleaned_rows),
             "errors": error_count,
-            "suggested_mapping": current_mapping if not library.csv_mapping else None
+            "suggested_mapping": current_mapping if saved_mapping is None else None
         }
 
     except Exception as e:
-        db.rollback()
+        await run_in_threadpool(db.rollback)
         logger.error(f"Error uploading CSV: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -633,9 +901,16 @@ async def upload_csv(
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
-    return {"status": "ok", "timestamp": datetime.utcnow().isoformat()}
+    return {"status": "ok", "timestamp": datetime.utcnow()}
 
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    uvicorn.run(
+        "app:app",
+        host="0.0.0.0",
+        port=8000,
+        loop="uvloop",
+        http="httptools",
+        workers=int(os.getenv("WEB_CONCURRENCY", 4))
+    )
\ No newline at end of file
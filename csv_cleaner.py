@@ -2,20 +2,136 @@
 CSV Cleaner - Limpieza crítica de datos DILVE
 UTF-8 roto, HTML tags, SEO optimization
 """
+import csv
+import html
+import io
 import re
 import unicodedata
-from typing import Dict, List
-from bs4 import BeautifulSoup
+from concurrent.futures import Executor
+import ftfy
+import orjson
+from typing import Dict, Iterable, Iterator, List, Optional, TextIO
+import lxml.html
+from lxml import etree
 from slugify import slugify
 import logging
-from thema_utils import map_thema_to_kusi
+from thema_utils import map_thema_batch, map_thema_to_kusi
+from mapping_utils import suggest_mapping
 
 logger = logging.getLogger(__name__)
 
+# Patrones compilados una sola vez (se aplican en cada fila)
+_RE_HTML = re.compile(r'<[^>]+>')
+_RE_WS = re.compile(r'\s+')
+_RE_CHARCLEAN = re.compile(r'[^\w\s\-áéíóúñüÁÉÍÓÚÑÜ.,;:!?()]')
+
+# Slug: acentos españoles → letra base; el resto de no-ASCII pasa por slugify
+_SLUG_TABLE = str.maketrans(
+    'áéíóúüÁÉÍÓÚÜÑñàèìòùÀÈÌÒÙçÇ¿¡«»–—…“”',
+    'aeiouuAEIOUUNnaeiouAEIOUcC         ',
+    '‘’'
+)
+_RE_SLUG_NUM_COMMA = re.compile(r'(?<=\d),(?=\d)')
+_RE_SLUG_NONALNUM = re.compile(r'[^a-z0-9]+')
+
+# Huellas de UTF-8 leído como latin-1/cp1252 (Ã¡, Â¿, â€œ...)
+_MOJIBAKE_MARKERS = ('Ã', 'Â', 'â€')
+
+
+def _build_mojibake_map() -> Dict[str, str]:
+    """
+    Secuencias rotas habituales en castellano → texto corregido
+    (bytes UTF-8 leídos como latin-1/cp1252; el valor es el de ftfy,
+    así el atajo y ftfy dan el mismo resultado, comillas rectas incluidas)
+    """
+    mapping = {}
+    for char in 'áéíóúüñÁÉÍÓÚÜÑàèìòùÀÈÌÒÙçÇ¿¡«»ºª°€–—…“”‘’·':
+        raw = char.encode('utf-8')
+        for encoding in ('latin-1', 'cp1252'):
+            try:
+                broken = raw.decode(encoding)
+            except UnicodeDecodeError:
+                continue
+            fixed = ftfy.fix_text(broken)
+            if fixed != broken:
+                mapping[broken] = fixed
+    return mapping
+
+
+_MOJIBAKE_MAP = _build_mojibake_map()
+# Una sola alternancia (las secuencias largas primero): una pasada por texto
+_MOJIBAKE_RE = re.compile('|'.join(map(re.escape, sorted(_MOJIBAKE_MAP, key=len, reverse=True))))
+
+
+class _CharCleanTable(dict):
+    """
+    Tabla para str.translate: borra lo que _RE_CHARCLEAN descarta
+    Se rellena por código de carácter la primera vez que aparece
+    """
+
+    def __missing__(self, codepoint: int):
+        value = None if _RE_CHARCLEAN.match(chr(codepoint)) else codepoint
+        self[codepoint] = value
+        return value
+
+
+_CHARCLEAN_TABLE = _CharCleanTable()
+
+# Nodos de texto visibles (como BeautifulSoup.get_text: sin script/style)
+_XPATH_TEXT = etree.XPath('//text()[not(ancestor::script or ancestor::style or ancestor::template)]')
+
+
+def html_to_text(text: str) -> str:
+    """
+    Texto de un fragmento HTML con el parser C de lxml
+    Equivale a BeautifulSoup(text).get_text(separator=' ', strip=True)
+    """
+    # Sin etiquetas ni entidades no hace falta parsear (caso habitual en títulos/autores)
+    if '<' not in text and '&' not in text:
+        return text.strip()
+    try:
+        root = lxml.html.fromstring(text)
+    except etree.ParserError:
+        # Documento vacío (solo espacios o comentarios)
+        return ""
+    return ' '.join(part for part in (node.strip() for node in _XPATH_TEXT(root)) if part)
+
 
 class CSVCleaner:
     """Limpia datos sucios de DILVE para WooCommerce"""
 
+    # Mapeo de headers KusiBook -> WooCommerce (campos oficiales)
+    # WC Header: KusiBook Field
+    WC_MAPPING = {
+        'sku': 'sku',
+        'name': 'post_title',
+        'published': None,  # '1' por defecto
+        'short_description': 'post_excerpt',
+        'description': 'post_content',
+        'regular_price': 'regular_price',
+        'sale_price': 'sale_price',
+        'stock_quantity': 'stock',
+        'stock_status': 'stock_status',
+        'manage_stock': None, # '1' por defecto
+        'categories': 'category_main',
+        'images': 'image_url',
+        'slug': 'post_name',
+        'meta:isbn13': 'isbn13',
+        'meta:author': 'author',
+        'meta:publisher': 'publisher',
+        'meta:seo_title': 'seo_title',
+        'meta:seo_description': 'seo_description'
+    }
+    # Filas por lote al limpiar en paralelo (clean_csv con executor)
+    CLEAN_CHUNK_SIZE = 2000
+
+    # Precalculados una vez: cabecera y (campo, valor por defecto) por columna
+    WC_HEADERS = tuple(WC_MAPPING)
+    _WC_PLAN = tuple(
+        (kusi_field, '1' if header in ('published', 'manage_stock') else "")
+        for header, kusi_field in WC_MAPPING.items()
+    )
+
     @staticmethod
     def fix_utf8_encoding(text: str) -> str:
         """
@@ -24,11 +140,17 @@ class CSVCleaner:
         if not text:
             return ""
 
+        # Texto sin huellas de UTF-8 roto: se deja tal cual (caso habitual)
+        if not any(marker in text for marker in _MOJIBAKE_MARKERS):
+            return text.strip()
+
+        # Vocabulario conocido en una pasada; ftfy solo si quedan restos
+        text = _MOJIBAKE_RE.sub(lambda m: _MOJIBAKE_MAP[m.group(0)], text)
+        if not any(marker in text for marker in _MOJIBAKE_MARKERS):
+            return text.strip()
+
         try:
-            # Intenta decodificar como latin-1 y recodificar como UTF-8
-            if isinstance(text, str):
-                # Detecta patrones de UTF-8 roto
-                text = text.encode('latin-1', errors='ignore').decode('utf-8', errors='ignore')
+            text = ftfy.fix_text(text)
         except Exception as e:
             logger.warning(f"Error fixing UTF-8: {e}")
 
@@ -45,18 +167,33 @@ class CSVCleaner:
             return ""
 
         try:
-            soup = BeautifulSoup(text, 'html.parser')
-            text = soup.get_text(separator=' ', strip=True)
+            text = html_to_text(text)
         except Exception as e:
             logger.warning(f"Error stripping HTML: {e}")
             # Fallback: regex simple
-            text = re.sub(r'<[^>]+>', '', text)
+            text = _RE_HTML.sub('', text)
 
         # Limpia espacios múltiples
-        text = re.sub(r'\s+', ' ', text).strip()
+        text = _RE_WS.sub(' ', text).strip()
 
         return text
 
+    @staticmethod
+    def strip_html_fast(text: str) -> str:
+        """
+        Variante sin parser para campos cortos (título, autor)
+        Quita tags con regex y decodifica entidades con html.unescape
+        """
+        if not text:
+            return ""
+
+        if '<' in text:
+            text = _RE_HTML.sub(' ', text)
+        if '&' in text:
+            text = html.unescape(text)
+
+        return _RE_WS.sub(' ', text).strip()
+
     @staticmethod
     def clean_description(text: str, max_length: int = 500) -> str:
         """
@@ -71,8 +208,9 @@ class CSVCleaner:
         # 2. Elimina HTML
         text = CSVCleaner.strip_html_tags(text)
 
-        # 3. Limpia caracteres especiales
-        text = re.sub(r'[^\w\s\-áéíóúñüÁÉÍÓÚÑÜ.,;:!?()]', '', text)
+        # 3. Limpia caracteres especiales (str.translate, un recorrido en C)
+        #    y colapsa los espacios que quedan al borrarlos
+        text = _RE_WS.sub(' ', text.translate(_CHARCLEAN_TABLE))
 
         # 4. Trunca
         if len(text) > max_length:
@@ -89,13 +227,21 @@ class CSVCleaner:
             return ""
 
         title = CSVCleaner.fix_utf8_encoding(title)
-        title = CSVCleaner.strip_html_tags(title)
-
+        title = CSVCleaner.strip_html_fast(title)
         if author:
             author = CSVCleaner.fix_utf8_encoding(author)
-            seo_title = f"{title} | {author}"
-        else:
-            seo_title = title
+
+        return CSVCleaner._seo_title_from_clean(title, author, max_length)
+
+    @staticmethod
+    def _seo_title_from_clean(title: str, author: Optional[str], max_length: int = 60) -> str:
+        """
+        generate_seo_title para título/autor ya limpios (sin volver a limpiarlos)
+        """
+        if not title:
+            return ""
+
+        seo_title = f"{title} | {author}" if author else title
 
         if len(seo_title) > max_length:
             seo_title = seo_title[:max_length].rsplit(' ', 1)[0]
@@ -122,15 +268,31 @@ class CSVCleaner:
             return ""
 
         title = CSVCleaner.fix_utf8_encoding(title)
-        title = CSVCleaner.strip_html_tags(title)
-
+        title = CSVCleaner.strip_html_fast(title)
         if author:
             author = CSVCleaner.fix_utf8_encoding(author)
-            slug_text = f"{title} {author}"
-        else:
-            slug_text = title
 
-        return slugify(slug_text, max_length=100)
+        return CSVCleaner._slug_from_clean(title, author)
+
+    @staticmethod
+    def _slug_from_clean(title: str, author: Optional[str]) -> str:
+        """
+        generate_slug para título/autor ya limpios (sin volver a limpiarlos)
+        """
+        if not title:
+            return ""
+
+        slug_text = f"{title} {author}" if author else title
+
+        # Camino rápido para el alfabeto español (mismo resultado que slugify)
+        ascii_text = slug_text.translate(_SLUG_TABLE)
+        if not ascii_text.isascii():
+            # Otros alfabetos o ligaduras (ß, œ...): transliteración completa
+            return slugify(slug_text, max_length=100)
+
+        slug = _RE_SLUG_NUM_COMMA.sub('', ascii_text.lower())
+        slug = _RE_SLUG_NONALNUM.sub('-', slug).strip('-')
+        return slug[:100].strip('-')
 
     @staticmethod
     def calculate_seo_score(book_data: Dict) -> int:
@@ -178,9 +340,15 @@ class CSVCleaner:
         return min(score, 100)
 
     @staticmethod
-    def clean_row(row: Dict) -> Dict:
+    def _thema_code(row: Dict) -> str:
+        """Código Thema de una fila (o IBIC si no hay Thema)"""
+        return row.get('thema_code', row.get('materia_ibic', ''))
+
+    @staticmethod
+    def clean_row(row: Dict, category: Optional[str] = None) -> Dict:
         """
         Limpia una fila completa de CSV DILVE
+        `category` permite pasar la categoría ya resuelta (map_thema_batch por lote)
         """
         try:
             # Extrae campos
@@ -193,10 +361,10 @@ class CSVCleaner:
 
             # Limpia valores
             title = CSVCleaner.fix_utf8_encoding(title)
-            title = CSVCleaner.strip_html_tags(title)
+            title = CSVCleaner.strip_html_fast(title)
 
             author = CSVCleaner.fix_utf8_encoding(author)
-            author = CSVCleaner.strip_html_tags(author)
+            author = CSVCleaner.strip_html_fast(author)
 
             description_clean = CSVCleaner.clean_description(description)
 
@@ -214,9 +382,9 @@ class CSVCleaner:
 
             stock_status = 'instock' if stock > 0 else 'out_of_stock'
 
-            # SEO
-            seo_title = CSVCleaner.generate_seo_title(title, author)
-            slug = CSVCleaner.generate_slug(title, author)
+            # SEO (título y autor ya están limpios)
+            seo_title = CSVCleaner._seo_title_from_clean(title, author)
+            slug = CSVCleaner._slug_from_clean(title, author)
 
             cleaned_row = {
                 'isbn13': isbn,
@@ -231,7 +399,7 @@ class CSVCleaner:
                 'stock': stock,
                 'stock_status': stock_status,
                 'manage_stock': True,
-                'categories': map_thema_to_kusi(row.get('thema_code', row.get('materia_ibic', ''))),
+                'categories': category if category is not None else map_thema_to_kusi(CSVCleaner._thema_code(row)),
                 'images': row.get('images', ''),
             }
 
@@ -245,16 +413,39 @@ class CSVCleaner:
             return None
 
     @staticmethod
-    def clean_csv(rows: List[Dict]) -> tuple[List[Dict], int]:
+    def clean_csv(rows: List[Dict], executor: Optional[Executor] = None) -> tuple[List[Dict], int]:
         """
         Limpia lista de filas CSV
+        Con `executor` (ProcessPoolExecutor) reparte lotes de CLEAN_CHUNK_SIZE filas entre procesos
         Retorna (cleaned_rows, error_count)
         """
+        size = CSVCleaner.CLEAN_CHUNK_SIZE
+        if executor is None or len(rows) <= size:
+            return CSVCleaner._clean_chunk(rows)
+
+        cleaned_rows = []
+        error_count = 0
+
+        # clean_row es puro: los lotes se limpian en paralelo y se unen en orden
+        chunks = (rows[i:i + size] for i in range(0, len(rows), size))
+        for cleaned, errors in executor.map(CSVCleaner._clean_chunk, chunks):
+            cleaned_rows.extend(cleaned)
+            error_count += errors
+
+        return cleaned_rows, error_count
+
+    @staticmethod
+    def _clean_chunk(rows: List[Dict]) -> tuple[List[Dict], int]:
+        """
+        Limpia un lote de filas en el proceso actual
+        """
         cleaned_rows = []
         error_count = 0
+        # Categorías Thema de todo el lote: una búsqueda por código distinto
+        categories = map_thema_batch([CSVCleaner._thema_code(row) for row in rows])
 
-        for row in rows:
-            cleaned = CSVCleaner.clean_row(row)
+        for row, category in zip(rows, categories):
+            cleaned = CSVCleaner.clean_row(row, category)
             if cleaned:
                 cleaned_rows.append(cleaned)
             else:
@@ -263,57 +454,107 @@ class CSVCleaner:
         return cleaned_rows, error_count
 
     @staticmethod
-    def to_woocommerce_csv(cleaned_rows: List[Dict]) -> str:
+    def clean_csv_to_jsonl(
+        rows: List[Dict], out_path: str, executor: Optional[Executor] = None
+    ) -> tuple[int, int]:
+        """
+        Limpia filas y las guarda como JSONL (orjson, una fila por línea)
+        Los exportadores leen luego read_jsonl sin volver a limpiar
+        Retorna (processed, error_count)
+        """
+        cleaned_rows, error_count = CSVCleaner.clean_csv(rows, executor=executor)
+
+        with open(out_path, 'wb', buffering=1 << 20) as f:
+            for row in cleaned_rows:
+                f.write(orjson.dumps(row))
+                f.write(b'\n')
+
+        return len(cleaned_rows), error_count
+
+    @staticmethod
+    def read_jsonl(path: str) -> Iterator[Dict]:
+        """
+        Lee filas limpias guardadas por clean_csv_to_jsonl, una a una
+        """
+        with open(path, 'rb') as f:
+            for line in f:
+                if line.strip():
+                    yield orjson.loads(line)
+
+    @staticmethod
+    def process_upload(content: bytes, mapping: Optional[Dict[str, str]] = None) -> Dict:
+        """
+        Decodifica, re-mapea y limpia un CSV subido
+        Sin mapping, sugiere uno a partir de las cabeceras
+        Solo recibe y retorna datos serializables (apto para ProcessPoolExecutor)
+        """
+        csv_text = content.decode('utf-8', errors='ignore')
+
+        # csv.reader tolera filas irregulares como DictReader: los campos de más
+        # se ignoran y los que faltan quedan vacíos
+        reader = csv.reader(io.StringIO(csv_text))
+        headers = next(reader, None)
+        if not headers:
+            return {"headers": None, "mapping": mapping, "processed": 0, "cleaned_rows": [], "errors": 0}
+
+        # No se guarda automáticamente, el usuario debe confirmarlo
+        current_mapping = mapping if mapping is not None else suggest_mapping(headers)
+
+        # Re-mapear al estándar KusiDilve con un plan posicional calculado una vez
+        # (-1 = cabecera ausente, queda vacía)
+        col_idx = {header: i for i, header in enumerate(headers)}
+        plan = [(kusi_field, col_idx.get(user_header, -1)) for kusi_field, user_header in current_mapping.items()]
+        remapped_rows = [
+            {kusi_field: (values[i] if 0 <= i < len(values) else "") for kusi_field, i in plan}
+            for values in reader
+            if values
+        ]
+
+        # Limpia con el pipeline existente
+        cleaned_rows, error_count = CSVCleaner.clean_csv(remapped_rows)
+
+        return {
+            "headers": headers,
+            "mapping": current_mapping,
+            "processed": len(remapped_rows),
+            "cleaned_rows": cleaned_rows,
+            "errors": error_count
+        }
+
+    @staticmethod
+    def process_upload_file(path: str, mapping: Optional[Dict[str, str]] = None) -> Dict:
+        """
+        Igual que process_upload, leyendo el CSV desde un fichero en disco
+        """
+        with open(path, 'rb') as f:
+            content = f.read()
+        return CSVCleaner.process_upload(content, mapping)
+
+    @staticmethod
+    def woocommerce_values(row: Dict) -> List:
+        """
+        Valores de una fila limpia en el orden de WC_MAPPING
+        """
+        get = row.get
+        return [
+            default if kusi_field is None else ("" if (val := get(kusi_field, "")) is None else val)
+            for kusi_field, default in CSVCleaner._WC_PLAN
+        ]
+
+    @staticmethod
+    def to_woocommerce_csv(cleaned_rows: Iterable[Dict], output: Optional[TextIO] = None) -> str:
         """
         Convierte filas limpias a formato CSV WooCommerce Estándar
         Mapea campos KusiBook -> WooCommerce Product CSV Importer
+        Acepta una lista o un iterador (p. ej. read_jsonl)
+        Con `output` (fichero abierto con newline='') escribe ahí fila a fila y retorna ""
         """
         if not cleaned_rows:
             return ""
 
-        # Mapeo de headers KusiBook -> WooCommerce (campos oficiales)
-        # WC Header: KusiBook Field
-        wc_mapping = {
-            'sku': 'sku',
-            'name': 'post_title',
-            'published': None,  # '1' por defecto
-            'short_description': 'post_excerpt',
-            'description': 'post_content',
-            'regular_price': 'regular_price',
-            'sale_price': 'sale_price',
-            'stock_quantity': 'stock',
-            'stock_status': 'stock_status',
-            'manage_stock': None, # '1' por defecto
-            'categories': 'category_main',
-            'images': 'image_url',
-            'slug': 'post_name',
-            'meta:isbn13': 'isbn13',
-            'meta:author': 'author',
-            'meta:publisher': 'publisher',
-            'meta:seo_title': 'seo_title',
-            'meta:seo_description': 'seo_description'
-        }
+        buf = output if output is not None else io.StringIO()
+        writer = csv.writer(buf, quoting=csv.QUOTE_MINIMAL, lineterminator='\n')
+        writer.writerow(CSVCleaner.WC_HEADERS)
+        writer.writerows(CSVCleaner.woocommerce_values(row) for row in cleaned_rows)
 
-        headers = list(wc_mapping.keys())
-        csv_lines = [','.join(headers)]
-
-        for row in cleaned_rows:
-            csv_values = []
-            for header in headers:
-                kusi_field = wc_mapping[header]
-                val = ""
-                
-                if kusi_field is None:
-                    if header in ['published', 'manage_stock']:
-                        val = '1'
-                else:
-                    val = row.get(kusi_field, "")
-                    if val is None: val = ""
-                
-                # Escapado simple de comas para CSV
-                str_val = str(val).replace('"', '""')
-                csv_values.append(f'"{str_val}"')
-            
-            csv_lines.append(','.join(csv_values))
-
-        return '\n'.join(csv_lines)
+        return buf.getvalue() if output is None else ""
@@ -3,13 +3,22 @@ WP All Import Module - Exportación optimizada para WordPress
 Convierte DILVE → WP All Import Step 4 (drag&drop ready)
 """
 import csv
+import io
 import re
-from bs4 import BeautifulSoup
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, TextIO, Tuple
 import logging
+from functools import lru_cache
+from itertools import islice
+import pandas as pd
+from csv_cleaner import CSVCleaner, html_to_text
 
 logger = logging.getLogger(__name__)
 
+# Patrones compilados una sola vez (se aplican en cada fila)
+_RE_CHARCLEAN = re.compile(r'[^\w\sáéíóúñÁÉÍÓÚÑ\-.,;:!?¿¡\(\)]')
+_RE_SLUG = re.compile(r'[^a-z0-9ñáéíóú\-]')
+_RE_DASHES = re.compile(r'-+')
+
 # Campos exactos que WP All Import espera en Step 4
 WP_ALL_IMPORT_FIELDS = [
     '_id', 'post_title', 'post_content', 'post_excerpt', '_sku',
@@ -24,6 +33,9 @@ WP_ALL_IMPORT_FIELDS = [
 class WPAllImportConverter:
     """Convierte datos DILVE a formato WP All Import"""
 
+    # Filas de DILVE leídas y convertidas por bloque en process_dilve_csv
+    CSV_CHUNK_SIZE = 20000
+
     @staticmethod
     def clean_dilve_text(text: str, max_length: int = 1600) -> str:
         """
@@ -39,23 +51,14 @@ class WPAllImportConverter:
             return ""
 
         try:
-            # 1. Intenta decodificar UTF-8 roto
-            if isinstance(text, str):
-                try:
-                    text = text.encode('latin1').decode('utf-8', errors='replace')
-                except (UnicodeDecodeError, UnicodeEncodeError):
-                    pass
+            # 1. Arregla UTF-8 roto (solo si hay huellas de mojibake)
+            text = CSVCleaner.fix_utf8_encoding(text)
 
             # 2. Elimina HTML tags
-            soup = BeautifulSoup(text, 'html.parser')
-            text = soup.get_text(separator=' ', strip=True)
+            text = html_to_text(text)
 
             # 3. Limpia caracteres especiales (mantiene acentos españoles)
-            text = re.sub(
-                r'[^\w\sáéíóúñÁÉÍÓÚÑ\-.,;:!?¿¡\(\)]',
-                '',
-                text
-            )
+            text = _RE_CHARCLEAN.sub('', text)
 
             # 4. Limpia espacios múltiples
             text = ' '.join(text.split())
@@ -92,10 +95,10 @@ class WPAllImportConverter:
         slug = slug_text.lower()
 
         # Reemplaza espacios y caracteres especiales con guiones
-        slug = re.sub(r'[^a-z0-9ñáéíóú\-]', '-', slug)
+        slug = _RE_SLUG.sub('-', slug)
 
         # Elimina guiones múltiples
-        slug = re.sub(r'-+', '-', slug)
+        slug = _RE_DASHES.sub('-', slug)
 
         # Elimina guiones al inicio/final
         slug = slug.strip('-')
@@ -126,9 +129,18 @@ class WPAllImportConverter:
         return seo_title.strip()
 
     @staticmethod
-    def dilve_to_wp_all_import(dilve_row: Dict) -> Dict:
+    def dilve_to_wp_all_import(dilve_row: Dict) -> Optional[Dict]:
+        """
+        Convierte fila DILVE → WP All Import Step 4 como diccionario
+        """
+        values = WPAllImportConverter.dilve_to_wp_all_import_values(dilve_row)
+        return dict(zip(WP_ALL_IMPORT_FIELDS, values)) if values else None
+
+    @staticmethod
+    def dilve_to_wp_all_import_values(dilve_row: Dict) -> Optional[Tuple[str, ...]]:
         """
         Convierte fila DILVE → WP All Import Step 4 exacto
+        Valores en el orden de WP_ALL_IMPORT_FIELDS (listos para csv.writer)
         
         Mapeo de campos:
         - titulo → post_title (SEO optimizado)
@@ -149,73 +161,95 @@ class WPAllImportConverter:
             materia = dilve_row.get('materia_ibic', dilve_row.get('categories', 'General')).strip()
             portada_url = dilve_row.get('portada_url', dilve_row.get('images', '')).strip()
 
-            # Limpieza crítica
-            title_clean = WPAllImportConverter.clean_dilve_text(titulo)
-            desc_clean = WPAllImportConverter.clean_dilve_text(resumen, max_length=5000)
-            author_clean = WPAllImportConverter.clean_dilve_text(autor)
-
-            # SEO fields
-            seo_title = WPAllImportConverter.generate_seo_title(title_clean, author_clean)
-            slug = WPAllImportConverter.generate_wp_slug(title_clean, author_clean)
+            # Transformación pura cacheada (ISBN/títulos repetidos no se vuelven a limpiar)
+            return WPAllImportConverter._transform(
+                isbn13, titulo, autor, resumen, precio, precio_oferta, stock, materia, portada_url
+            )
 
-            # Excerpt (primeras 155 caracteres)
-            excerpt = desc_clean[:155] + '...' if len(desc_clean) > 155 else desc_clean
+        except Exception as e:
+            logger.error(f"Error converting row: {e}")
+            return None
 
-            # Stock logic
-            try:
-                stock_int = int(stock) if stock else 0
-            except ValueError:
-                stock_int = 0
+    @staticmethod
+    @lru_cache(maxsize=8192)
+    def _transform(
+        isbn13: str,
+        titulo: str,
+        autor: str,
+        resumen: str,
+        precio: str,
+        precio_oferta: str,
+        stock: str,
+        materia: str,
+        portada_url: str
+    ) -> Tuple[str, ...]:
+        """
+        Núcleo de dilve_to_wp_all_import: solo argumentos hashables
+        """
+        # Limpieza crítica
+        title_clean = WPAllImportConverter.clean_dilve_text(titulo)
+        desc_clean = WPAllImportConverter.clean_dilve_text(resumen, max_length=5000)
+        author_clean = WPAllImportConverter.clean_dilve_text(autor)
 
-            stock_status = 'instock' if stock_int > 0 else 'out_of_stock'
-            post_status = 'publish' if stock_status == 'instock' else 'draft'
+        # SEO fields
+        seo_title = WPAllImportConverter.generate_seo_title(title_clean, author_clean)
+        slug = WPAllImportConverter.generate_wp_slug(title_clean, author_clean)
 
-            # Precio
-            try:
-                regular_price = float(precio.replace(',', '.')) if precio else 0.0
-            except ValueError:
-                regular_price = 0.0
+        # Excerpt (primeras 155 caracteres)
+        excerpt = desc_clean[:155] + '...' if len(desc_clean) > 155 else desc_clean
 
-            try:
-                sale_price = float(precio_oferta.replace(',', '.')) if precio_oferta else ''
-            except ValueError:
-                sale_price = ''
+        # Stock logic
+        try:
+            stock_int = int(stock) if stock else 0
+        except ValueError:
+            stock_int = 0
 
-            # SKU basado en últimos 6 dígitos ISBN
-            sku = f"LIB{isbn13[-6:]}" if isbn13 else "LIB000000"
+        stock_status = 'instock' if stock_int > 0 else 'out_of_stock'
+        post_status = 'publish' if stock_status == 'instock' else 'draft'
 
-            return {
-                '_id': isbn13,
-                'post_title': seo_title,
-                'post_content': desc_clean,
-                'post_excerpt': excerpt,
-                '_sku': sku,
-                '_regular_price': str(regular_price),
-                '_sale_price': str(sale_price) if sale_price else '',
-                '_stock': str(stock_int),
-                '_manage_stock': '1',
-                '_virtual': '0',
-                '_downloadable': '0',
-                'product_cat': materia,
-                'tax_status': 'taxable',
-                'post_status': post_status,
-                'post_name': slug,
-                'images': portada_url,
-                'post_parent': '',
-                'menu_order': '0',
-                '_weight': '',
-                '_length': '',
-                '_width': '',
-                '_height': '',
-                '_shipping_class': '',
-                'attribute_pa_color': '',
-                'attribute_pa_size': '',
-                'attribute_pa_material': ''
-            }
+        # Precio
+        try:
+            regular_price = float(precio.replace(',', '.')) if precio else 0.0
+        except ValueError:
+            regular_price = 0.0
 
-        except Exception as e:
-            logger.error(f"Error converting row: {e}")
-            return None
+        try:
+            sale_price = float(precio_oferta.replace(',', '.')) if precio_oferta else ''
+        except ValueError:
+            sale_price = ''
+
+        # SKU basado en últimos 6 dígitos ISBN
+        sku = f"LIB{isbn13[-6:]}" if isbn13 else "LIB000000"
+
+        # Tupla inmutable en el orden de WP_ALL_IMPORT_FIELDS (segura para compartir desde la caché)
+        return (
+            isbn13,  # _id
+            seo_title,  # post_title
+            desc_clean,  # post_content
+            excerpt,  # post_excerpt
+            sku,  # _sku
+            str(regular_price),  # _regular_price
+            str(sale_price) if sale_price else '',  # _sale_price
+            str(stock_int),  # _stock
+            '1',  # _manage_stock
+            '0',  # _virtual
+            '0',  # _downloadable
+            materia,  # product_cat
+            'taxable',  # tax_status
+            post_status,  # post_status
+            slug,  # post_name
+            portada_url,  # images
+            '',  # post_parent
+            '0',  # menu_order
+            '',  # _weight
+            '',  # _length
+            '',  # _width
+            '',  # _height
+            '',  # _shipping_class
+            '',  # attribute_pa_color
+            '',  # attribute_pa_size
+            '',  # attribute_pa_material
+        )
 
     @staticmethod
     def process_dilve_csv(
@@ -237,49 +271,67 @@ class WPAllImportConverter:
                 'instock': 75,
                 'out_of_stock': 25,
                 'errors': 0,
+                'truncated': 0,
                 'output_file': 'path/to/file.csv'
             }
         """
-        wp_rows = []
         error_count = 0
+        truncated_count = 0
 
         try:
-            # Lee CSV DILVE
-            with open(input_file, 'r', encoding='utf-8') as f:
-                reader = csv.DictReader(f, delimiter=delimiter)
-
-                if not reader.fieldnames:
+            # Lee CSV DILVE con csv.reader, por bloques: la memoria no crece con el
+            # tamaño del feed. Las filas con campos de más se recortan, se escriben y
+            # cuentan en 'truncated'; las cortas se completan con vacíos (como DictReader).
+            # 'errors' queda para filas descartadas
+            with open(input_file, newline='', encoding='utf-8') as src:
+                reader = csv.reader(src, delimiter=delimiter)
+                headers = next(reader, None)
+                if not headers:
                     raise ValueError("CSV vacío o sin headers")
-
-                for row_num, row in enumerate(reader, 1):
-                    try:
-                        wp_row = WPAllImportConverter.dilve_to_wp_all_import(row)
-                        if wp_row:
-                            wp_rows.append(wp_row)
-                        else:
-                            error_count += 1
-                    except Exception as e:
-                        logger.error(f"Error en fila {row_num}: {e}")
-                        error_count += 1
-
-            # Escribe CSV WP All Import (drag&drop Step 4)
-            with open(output_file, 'w', newline='', encoding='utf-8') as f:
-                writer = csv.DictWriter(f, fieldnames=WP_ALL_IMPORT_FIELDS)
-                writer.writeheader()
-                writer.writerows(wp_rows)
-
-            # Estadísticas
-            instock_count = len([r for r in wp_rows if r['post_status'] == 'publish'])
-            out_of_stock_count = len([r for r in wp_rows if r['post_status'] == 'draft'])
+                width = len(headers)
+
+                total = instock_count = out_of_stock_count = 0
+
+                # Escribe CSV WP All Import (drag&drop Step 4) bloque a bloque
+                with open(output_file, 'w', newline='', encoding='utf-8') as f:
+                    first = True
+                    while True:
+                        chunk = []
+                        for values in islice(reader, WPAllImportConverter.CSV_CHUNK_SIZE):
+                            if not values:
+                                continue
+                            if len(values) > width:
+                                truncated_count += 1
+                                values = values[:width]
+                            elif len(values) < width:
+                                values = values + [''] * (width - len(values))
+                            chunk.append(values)
+                        if not chunk:
+                            break
+
+                        df = pd.DataFrame(chunk, columns=headers, dtype=str)
+                        wp_df = WPAllImportConverter.dilve_frame_to_wp_all_import(df)
+                        wp_df.to_csv(f, index=False, header=first, columns=WP_ALL_IMPORT_FIELDS)
+                        first = False
+
+                        # Estadísticas
+                        status_counts = wp_df['post_status'].value_counts()
+                        total += len(wp_df)
+                        instock_count += int(status_counts.get('publish', 0))
+                        out_of_stock_count += int(status_counts.get('draft', 0))
+
+            if truncated_count:
+                logger.warning(f"WP All Import: {truncated_count} filas con campos de más (recortadas)")
 
             result = {
                 'status': 'success',
-                'total': len(wp_rows),
+                'total': total,
                 'instock': instock_count,
                 'out_of_stock': out_of_stock_count,
                 'errors': error_count,
+                'truncated': truncated_count,
                 'output_file': output_file,
-                'percentage_instock': round((instock_count / len(wp_rows) * 100) if wp_rows else 0, 1)
+                'percentage_instock': round((instock_count / total * 100) if total else 0, 1)
             }
 
             logger.info(f"WP All Import conversion: {result}")
@@ -295,35 +347,97 @@ class WPAllImportConverter:
             }
 
     @staticmethod
-    def to_wp_all_import_csv(cleaned_rows: List[Dict]) -> str:
+    def dilve_frame_to_wp_all_import(df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Versión por columnas de dilve_to_wp_all_import para un CSV completo
+        Precios, stock, SKU y estados se calculan vectorizados; el texto
+        (UTF-8, HTML, slug) se limpia fila a fila con los mismos helpers
+        """
+        def column(*names: str, default: str = '') -> pd.Series:
+            # Igual que row.get(a, row.get(b, default)): primera columna presente
+            for name in names:
+                if name in df.columns:
+                    return df[name].str.strip()
+            return pd.Series(default.strip(), index=df.index, dtype=object)
+
+        isbn13 = column('isbn13')
+        precio = column('precio', 'price', default='0')
+        precio_oferta = column('precio_oferta', 'sale_price')
+        stock = column('stock', default='0')
+
+        # Limpieza crítica (por fila)
+        clean = WPAllImportConverter.clean_dilve_text
+        title_clean = [clean(t) for t in column('titulo', 'title')]
+        author_clean = [clean(a) for a in column('autor', 'author')]
+        desc_clean = [clean(d, max_length=5000) for d in column('resumen', 'description')]
+
+        # Stock: enteros válidos, el resto 0
+        stock_int = pd.to_numeric(stock.where(stock.str.fullmatch(r'[+-]?\d+'), '0')).astype(int)
+        instock = stock_int > 0
+
+        # Precios con coma o punto decimal; inválidos → 0.0 / vacío
+        regular_price = pd.to_numeric(precio.str.replace(',', '.'), errors='coerce').fillna(0.0)
+        sale_price = pd.to_numeric(precio_oferta.str.replace(',', '.'), errors='coerce')
+        sale_price_str = sale_price.astype(str).where(sale_price.notna() & (sale_price != 0), '')
+
+        excerpt = [d[:155] + '...' if len(d) > 155 else d for d in desc_clean]
+
+        wp_df = pd.DataFrame({
+            '_id': isbn13,
+            'post_title': [
+                WPAllImportConverter.generate_seo_title(t, a) for t, a in zip(title_clean, author_clean)
+            ],
+            'post_content': desc_clean,
+            'post_excerpt': excerpt,
+            '_sku': ('LIB' + isbn13.str[-6:]).where(isbn13 != '', 'LIB000000'),
+            '_regular_price': regular_price.astype(str),
+            '_sale_price': sale_price_str,
+            '_stock': stock_int.astype(str),
+            '_manage_stock': '1',
+            '_virtual': '0',
+            '_downloadable': '0',
+            'product_cat': column('materia_ibic', 'categories', default='General'),
+            'tax_status': 'taxable',
+            'post_status': instock.map({True: 'publish', False: 'draft'}),
+            'post_name': [
+                WPAllImportConverter.generate_wp_slug(t, a) for t, a in zip(title_clean, author_clean)
+            ],
+            'images': column('portada_url', 'images'),
+            'menu_order': '0',
+        }, index=df.index)
+
+        # Columnas siempre vacías
+        for field in WP_ALL_IMPORT_FIELDS:
+            if field not in wp_df.columns:
+                wp_df[field] = ''
+
+        return wp_df[WP_ALL_IMPORT_FIELDS]
+
+    @staticmethod
+    def to_wp_all_import_csv(cleaned_rows: List[Dict], output: Optional[TextIO] = None) -> str:
         """
         Convierte lista de filas limpias a CSV WP All Import
         
         Args:
             cleaned_rows: Lista de diccionarios con datos limpios
+            output: Fichero abierto (newline='') donde escribir fila a fila
         
         Returns:
-            String con contenido CSV
+            String con contenido CSV ("" si se escribió en `output`)
         """
         if not cleaned_rows:
             return ""
 
-        output = []
+        buf = output if output is not None else io.StringIO()
+        writer = csv.writer(buf, quoting=csv.QUOTE_MINIMAL, lineterminator='\n')
+        writer.writerow(WP_ALL_IMPORT_FIELDS)
 
-        # Headers
-        output.append(','.join(WP_ALL_IMPORT_FIELDS))
-
-        # Rows
         for row in cleaned_rows:
-            wp_row = WPAllImportConverter.dilve_to_wp_all_import(row)
-            if wp_row:
-                csv_row = [
-                    str(wp_row.get(field, '')).replace(',', ';')
-                    for field in WP_ALL_IMPORT_FIELDS
-                ]
-                output.append(','.join(f'"{val}"' for val in csv_row))
+            wp_values = WPAllImportConverter.dilve_to_wp_all_import_values(row)
+            if wp_values:
+                writer.writerow(wp_values)
 
-        return '\n'.join(output)
+        return buf.getvalue() if output is None else ""
 
 
 class WPAllImportStats:
@@ -338,28 +452,34 @@ class WPAllImportStats:
             return {}
 
         total = len(wp_rows)
-        instock = len([r for r in wp_rows if r['post_status'] == 'publish'])
-        out_of_stock = total - instock
-
-        # Categorías
+        instock = 0
         categories = {}
+        prices_count = 0
+        prices_sum = 0.0
+        min_price = max_price = 0
+
+        # Una sola pasada: stock, categorías y rango de precios
         for row in wp_rows:
+            if row['post_status'] == 'publish':
+                instock += 1
+
             cat = row.get('product_cat', 'General')
             categories[cat] = categories.get(cat, 0) + 1
 
-        # Rango de precios
-        prices = []
-        for row in wp_rows:
             try:
                 price = float(row.get('_regular_price', 0))
-                if price > 0:
-                    prices.append(price)
             except ValueError:
-                pass
+                continue
+            if price > 0:
+                if not prices_count or price < min_price:
+                    min_price = price
+                if price > max_price:
+                    max_price = price
+                prices_count += 1
+                prices_sum += price
 
-        avg_price = sum(prices) / len(prices) if prices else 0
-        min_price = min(prices) if prices else 0
-        max_price = max(prices) if prices else 0
+        out_of_stock = total - instock
+        avg_price = prices_sum / prices_count if prices_count else 0
 
         return {
             'total_products': total,
@@ -370,7 +490,7 @@ class WPAllImportStats:
             'avg_price': round(avg_price, 2),
             'min_price': round(min_price, 2),
             'max_price': round(max_price, 2),
-            'total_value': round(sum(prices), 2)
+            'total_value': round(prices_sum, 2)
         }
 
     @staticmethod
@@ -432,4 +552,5 @@ if __name__ == "__main__":
     print(f"   - Con stock: {result['instock']}")
     print(f"   - Sin stock: {result['out_of_stock']}")
     print(f"   - Errores: {result['errors']}")
+    print(f"   - Recortadas: {result['truncated']}")
     print(f"\n📁 Archivo: {result['output_file']}")
@@ -1,18 +1,45 @@
 """
 SQLAlchemy models and database setup for KusiDilve
 """
-from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, ForeignKey, Boolean, Text
+from sqlalchemy import create_engine, event, inspect, make_url, text, Index, Column, Integer, SmallInteger, String, Float, DateTime, ForeignKey, Boolean, Text, JSON
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
 from datetime import datetime
+from itertools import islice
+from typing import Iterable
 import os
 
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./kusi_dilve.db")
 
-engine = create_engine(
-    DATABASE_URL,
-    connect_args={"check_same_thread": False} if "sqlite" in DATABASE_URL else {}
-)
+engine_options = {"insertmanyvalues_page_size": 10_000}
+
+if "sqlite" in DATABASE_URL:
+    engine_options["connect_args"] = {"check_same_thread": False}
+else:
+    # Descarta conexiones cortadas por el servidor antes de un sync largo
+    engine_options["pool_pre_ping"] = True
+
+database_url = make_url(DATABASE_URL)
+if database_url.get_backend_name() == "postgresql" and database_url.get_driver_name() == "psycopg2":
+    # execute_values para INSERT y execute_batch para UPDATE/DELETE en executemany()
+    engine_options["executemany_mode"] = "values_plus_batch"
+    engine_options["executemany_batch_page_size"] = 500
+
+engine = create_engine(DATABASE_URL, **engine_options)
+
+if database_url.get_backend_name() == "sqlite":
+    @event.listens_for(engine, "connect")
+    def _sqlite_pragmas(dbapi_connection, connection_record):
+        # WAL: las lecturas de la API no esperan a las importaciones masivas
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.execute("PRAGMA mmap_size=268435456")
+        cursor.execute("PRAGMA cache_size=-65536")
+        cursor.close()
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
@@ -33,7 +60,7 @@ class Library(Base):
     books_count = Column(Integer, default=0)
     
     # Mapping and AI Config
-    csv_mapping = Column(Text, nullable=True)  # JSON string
+    csv_mapping = Column(JSON().with_variant(JSONB, "postgresql"), nullable=True)  # {campo_kusi: cabecera}
     use_ai_seo = Column(Boolean, default=False)
     gemini_api_key = Column(String, nullable=True)
     openai_api_key = Column(String, nullable=True)
@@ -53,10 +80,18 @@ class Library(Base):
 
 class Book(Base):
     __tablename__ = "books"
+    __table_args__ = (
+        # Búsquedas por ISBN dentro de una librería (sync DILVE, upserts)
+        Index("ix_book_library_isbn", "library_id", "isbn13", unique=True),
+        # Exports y sync WooCommerce filtran por is_dirty
+        Index("ix_book_library_dirty", "library_id", "is_dirty"),
+        # Cubre el agregado del dashboard (sin leer la tabla)
+        Index("ix_book_library_stats", "library_id", "stock", "is_dirty", "score_seo"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
-    library_id = Column(Integer, ForeignKey("libraries.id"), index=True)
-    isbn13 = Column(String, index=True)
+    library_id = Column(Integer, ForeignKey("libraries.id"))  # prefijo de ix_book_library_isbn
+    isbn13 = Column(String)
     title = Column(String)
     author = Column(String, nullable=True)
     description = Column(Text, nullable=True)
@@ -89,7 +124,7 @@ class Book(Base):
 
     seo_title = Column(String, nullable=True)
     slug = Column(String, nullable=True)
-    score_seo = Column(Integer, default=0)
+    score_seo = Column(SmallInteger, default=0)  # 0-100
     is_dirty = Column(Boolean, default=True)
     sync_date = Column(DateTime, nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow)
@@ -138,8 +173,69 @@ class StripeSubscription(Base):
         from_attributes = True
 
 
-# Create tables
-Base.metadata.create_all(bind=engine)
+# Conserva la fila más reciente de cada (library_id, isbn13); los NULL no chocan en el índice único
+DEDUPE_BOOKS_SQL = text("""
+    DELETE FROM books
+    WHERE library_id IS NOT NULL AND isbn13 IS NOT NULL
+      AND id NOT IN (
+        SELECT max(id) FROM books
+        WHERE library_id IS NOT NULL AND isbn13 IS NOT NULL
+        GROUP BY library_id, isbn13
+      )
+""")
+
+
+def ensure_book_indexes(conn) -> int:
+    """
+    Crea en una tabla books ya existente los índices que create_all no añade
+    Antes del índice único borra los ISBN duplicados por librería. Retorna filas borradas
+    """
+    existing = {index["name"] for index in inspect(conn).get_indexes("books")}
+    removed = 0
+    if "ix_book_library_isbn" not in existing:
+        removed = conn.execute(DEDUPE_BOOKS_SQL).rowcount
+    for index in Book.__table__.indexes:
+        index.create(conn, checkfirst=True)
+    return removed
+
+
+def init_db():
+    """Crea las tablas que falten; lo llama el arranque de la app, no el import"""
+    Base.metadata.create_all(bind=engine)
+    with engine.begin() as conn:
+        ensure_book_indexes(conn)
+
+
+# Dialectos con INSERT ... ON CONFLICT (upsert en un solo executemany)
+UPSERT_DIALECTS = {"postgresql": postgresql.insert, "sqlite": sqlite.insert}
+
+
+def bulk_upsert_books(session, rows: Iterable[dict], chunk: int = 5000) -> int:
+    """
+    Alta o actualización de libros por (library_id, isbn13), un executemany por bloque
+    Usa el índice único ix_book_library_isbn; sin SELECT previo ni flush por fila
+    Acepta listas o iteradores: solo `chunk` filas en memoria a la vez. Retorna filas escritas
+    """
+    rows = iter(rows)
+    insert = UPSERT_DIALECTS[session.get_bind().dialect.name]
+    stmt = None
+    written = 0
+
+    while batch := list(islice(rows, chunk)):
+        if stmt is None:
+            stmt = insert(Book)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[Book.library_id, Book.isbn13],
+                set_={
+                    key: stmt.excluded[key]
+                    for key in [*batch[0], "updated_at"]
+                    if key not in ("library_id", "isbn13", "created_at")
+                }
+            )
+        session.execute(stmt, batch)
+        written += len(batch)
+
+    return written
 
 
 def get_db():
@@ -52,9 +52,12 @@ def main():
     # Estadísticas
     print("📊 Estadísticas:")
     print("-" * 60)
-    total_score = sum(r['score_seo'] for r in cleaned_rows)
+    total_score = 0
+    in_stock = 0
+    for r in cleaned_rows:
+        total_score += r['score_seo']
+        in_stock += r['stock_status'] == 'instock'
     avg_score = total_score / len(cleaned_rows) if cleaned_rows else 0
-    in_stock = sum(1 for r in cleaned_rows if r['stock_status'] == 'instock')
     out_of_stock = len(cleaned_rows) - in_stock
 
     print(f"  Total de libros: {len(cleaned_rows)}")
@@ -65,9 +68,8 @@ def main():
 
     # Exporta WooCommerce
     print("📥 Exportando a WooCommerce...")
-    wc_csv = CSVCleaner.to_woocommerce_csv(cleaned_rows)
-    with open('data/woocommerce_export.csv', 'w', encoding='utf-8') as f:
-        f.write(wc_csv)
+    with open('data/woocommerce_export.csv', 'w', encoding='utf-8', newline='', buffering=1 << 20) as f:
+        CSVCleaner.to_woocommerce_csv(cleaned_rows, output=f)
     print(f"✓ Exportado a: data/woocommerce_export.csv")
     print()
 
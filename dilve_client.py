@@ -3,10 +3,13 @@ DILVE Client - Integración con API DILVE
 Endpoints: getRecordStatusX, getRecordsX, FTP extractions
 """
 import httpx
+import orjson
+from cachetools import TTLCache
 import asyncio
 import logging
-from typing import List, Dict, Optional
+from typing import AsyncIterator, Awaitable, Callable, Dict, Iterable, Iterator, List, Optional
 from datetime import datetime
+from itertools import chain, islice
 import csv
 from io import StringIO
 
@@ -14,6 +17,14 @@ logger = logging.getLogger(__name__)
 
 DILVE_BASE = "https://www.dilve.es/dilve/dilve"
 
+# CSV de ejemplo con datos sucios (modo mock, sin FTP real)
+_MOCK_CSV = """isbn13,titulo,autor,descripcion,precio,stock
+9788496479685,TÃ­tulo con UTF-8 roto,Autor Ejemplo,"<p>DescripciÃ³n con HTML</p> &nbsp; &nbsp;",18.95,5
+9788496479686,Otro TÃ­tulo,Otro Autor,"Descripción normal",22.50,0
+9788496479687,TÃ­tulo Especial,Autor Especial,"<b>Negrita</b> y <i>cursiva</i>",15.00,12
+9788496479688,Libro sin stock,Desconocido,"Sin descripción",0.00,0
+9788496479689,Libro con acentos,José María,"Descripción con ñ y acentos",25.99,3"""
+
 
 class DilveClient:
     """Cliente para API DILVE"""
@@ -23,6 +34,23 @@ class DilveClient:
         self.password = password
         self.base_url = DILVE_BASE
         self.timeout = 30
+        # Cliente compartido: reutiliza conexiones TCP/TLS entre peticiones
+        self._client = httpx.AsyncClient(
+            timeout=self.timeout,
+            limits=httpx.Limits(max_connections=20, max_keepalive_connections=20)
+        )
+        # Respuestas de getRecordStatusX por (from_date, record_type), 60 s
+        self._status_cache = TTLCache(maxsize=256, ttl=60)
+
+    async def aclose(self):
+        """Cierra el cliente HTTP compartido"""
+        await self._client.aclose()
+
+    async def __aenter__(self) -> "DilveClient":
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.aclose()
 
     async def get_record_status(
         self,
@@ -43,6 +71,11 @@ class DilveClient:
                 "total": 123
             }
         """
+        key = (from_date, record_type)
+        cached = self._status_cache.get(key)
+        if cached is not None:
+            return cached
+
         try:
             url = f"{self.base_url}/getRecordStatusX.do"
             params = {
@@ -53,21 +86,21 @@ class DilveClient:
                 "format": "JSON"
             }
 
-            async with httpx.AsyncClient(timeout=self.timeout) as client:
-                response = await client.get(url, params=params)
-                response.raise_for_status()
+            response = await self._client.get(url, params=params)
+            response.raise_for_status()
 
-                # DILVE retorna CSV o JSON según formato
-                data = response.json() if response.headers.get('content-type') == 'application/json' else {
-                    "status": "success",
-                    "message": "Use CSV format for compatibility"
-                }
+            # DILVE retorna CSV o JSON según formato
+            data = orjson.loads(response.content) if response.headers.get('content-type') == 'application/json' else {
+                "status": "success",
+                "message": "Use CSV format for compatibility"
+            }
 
-                logger.info(f"DILVE getRecordStatus: {data}")
-                return data
+            logger.debug("DILVE getRecordStatus: %s", data)
+            self._status_cache[key] = data  # los errores no se cachean
+            return data
 
         except Exception as e:
-            logger.error(f"Error getting record status: {e}")
+            logger.error("Error getting record status: %s", e)
             return {
                 "status": "error",
                 "message": str(e),
@@ -95,7 +128,7 @@ class DilveClient:
         """
         try:
             if len(isbns) > 128:
-                logger.warning(f"DILVE limit: máximo 128 ISBNs, recibidos {len(isbns)}")
+                logger.warning("DILVE limit: máximo 128 ISBNs, recibidos %d", len(isbns))
                 isbns = isbns[:128]
 
             url = f"{self.base_url}/getRecordsX.do"
@@ -106,42 +139,50 @@ class DilveClient:
                 "password": self.password
             }
 
-            async with httpx.AsyncClient(timeout=self.timeout) as client:
-                response = await client.get(url, params=params)
-                response.raise_for_status()
+            response = await self._client.get(url, params=params)
+            response.raise_for_status()
 
-                if metadata_format == "CSV":
-                    records = self._parse_csv_response(response.text)
-                else:
-                    records = response.json()
+            if metadata_format == "CSV":
+                records = self._parse_csv_response(response.text)
+            else:
+                records = orjson.loads(response.content)
 
-                logger.info(f"DILVE getRecords: {len(records)} registros")
-                return {
-                    "status": "success",
-                    "records": records,
-                    "total": len(records)
-                }
+            logger.info("DILVE getRecords: %d registros", len(records))
+            return {
+                "status": "success",
+                "records": records,
+                "total": len(records)
+            }
 
         except Exception as e:
-            logger.error(f"Error getting records: {e}")
+            logger.error("Error getting records: %s", e)
             return {
                 "status": "error",
                 "message": str(e),
                 "records": []
             }
 
+    @staticmethod
+    def _iter_csv_response(lines: Iterable[str], chunk_size: int = 10_000) -> Iterator[List[Dict]]:
+        """
+        Parsea CSV de DILVE por bloques de `chunk_size` registros
+        Acepta cualquier iterable de líneas (StringIO, fichero, líneas de un stream)
+        Un error de parseo se propaga: no se devuelve un catálogo truncado como completo
+        """
+        # strict: un stream cortado dentro de un campo entrecomillado es error, no un registro más
+        reader = csv.reader(lines, strict=True)
+        header = tuple(next(reader, ()))
+        rows = filter(None, reader)  # salta líneas vacías, como DictReader
+        # csv.reader + zip en una comprensión: sin el __next__ en Python de DictReader
+        while batch := [dict(zip(header, row)) for row in islice(rows, chunk_size)]:
+            yield batch
+
     @staticmethod
     def _parse_csv_response(csv_text: str) -> List[Dict]:
         """
         Parsea respuesta CSV de DILVE
         """
-        try:
-            reader = csv.DictReader(StringIO(csv_text))
-            records = list(reader)
-            return records
-        except Exception as e:
-            logger.error(f"Error parsing CSV: {e}")
-            return []
+        return list(chain.from_iterable(DilveClient._iter_csv_response(StringIO(csv_text))))
 
     async def get_ftp_extractions(self) -> Dict:
         """
@@ -171,7 +212,7 @@ class DilveClient:
             }
 
         except Exception as e:
-            logger.error(f"Error getting FTP extractions: {e}")
+            logger.error("Error getting FTP extractions: %s", e)
             return {
                 "status": "error",
                 "message": str(e),
@@ -190,11 +231,11 @@ class DilveClient:
         """
         try:
             # Mock: retorna CSV de ejemplo
-            logger.info(f"Downloading extraction: {filename}")
+            logger.info("Downloading extraction: %s", filename)
             return self._get_mock_csv()
 
         except Exception as e:
-            logger.error(f"Error downloading extraction: {e}")
+            logger.error("Error downloading extraction: %s", e)
             return None
 
     @staticmethod
@@ -202,12 +243,7 @@ class DilveClient:
         """
         Retorna CSV mock con datos sucios (para testing)
         """
-        return """isbn13,titulo,autor,descripcion,precio,stock
-9788496479685,TÃ­tulo con UTF-8 roto,Autor Ejemplo,"<p>DescripciÃ³n con HTML</p> &nbsp; &nbsp;",18.95,5
-9788496479686,Otro TÃ­tulo,Otro Autor,"Descripción normal",22.50,0
-9788496479687,TÃ­tulo Especial,Autor Especial,"<b>Negrita</b> y <i>cursiva</i>",15.00,12
-9788496479688,Libro sin stock,Desconocido,"Sin descripción",0.00,0
-9788496479689,Libro con acentos,José María,"Descripción con ñ y acentos",25.99,3"""
+        return _MOCK_CSV
 
 
 class DilveSync:
@@ -219,10 +255,12 @@ class DilveSync:
     async def sync_from_date(
         self,
         from_date: str,
-        record_type: str = "A"
+        record_type: str = "A",
+        concurrency: int = 10
     ) -> Dict:
         """
         Sincroniza cambios desde fecha específica
+        Descarga hasta `concurrency` lotes de ISBNs en paralelo
         """
         try:
             # 1. Obtiene cambios
@@ -241,11 +279,23 @@ class DilveSync:
                     "records": []
                 }
 
-            # 3. Obtiene registros completos (en lotes de 128)
+            # 3. Obtiene registros completos (en lotes de 128, hasta `concurrency` a la vez)
+            semaphore = asyncio.Semaphore(concurrency)
+
+            async def fetch_batch(batch: List[str]) -> Dict:
+                async with semaphore:
+                    return await self.client.get_records(batch)
+
+            results = await asyncio.gather(*(
+                fetch_batch(isbns[i:i+128]) for i in range(0, len(isbns), 128)
+            ), return_exceptions=True)
+
+            # Un lote fallido no cancela los demás
             all_records = []
-            for i in range(0, len(isbns), 128):
-                batch = isbns[i:i+128]
-                result = await self.client.get_records(batch)
+            for result in results:
+                if isinstance(result, Exception):
+                    logger.error("DILVE batch failed: %s", result)
+                    continue
                 all_records.extend(result.get("records", []))
 
             return {
@@ -255,17 +305,33 @@ class DilveSync:
             }
 
         except Exception as e:
-            logger.error(f"Error syncing from date: {e}")
+            logger.error("Error syncing from date: %s", e)
             return {
                 "status": "error",
                 "message": str(e),
                 "records": []
             }
 
-    async def sync_full_catalog(self) -> Dict:
+    async def iter_extraction(self, filename: str, chunk_size: int = 10_000) -> AsyncIterator[List[Dict]]:
+        """
+        Recorre una extracción FTP por bloques de `chunk_size` registros
+        Permite limpiar y guardar cada bloque sin materializar el catálogo entero
+        """
+        csv_content = await self.client.download_extraction(filename)
+        if not csv_content:
+            raise RuntimeError(f"Failed to download {filename}")
+
+        for batch in DilveClient._iter_csv_response(StringIO(csv_content), chunk_size):
+            yield batch
+
+    async def sync_full_catalog(self, on_batch: Callable[[List[Dict]], Awaitable[None]]) -> Dict:
         """
         Sincroniza catálogo completo (desde FTP)
+        Entrega cada bloque a `on_batch` (corutina) en vez de acumular el catálogo
+        Si la extracción falla a medias retorna status "error" con los registros ya entregados
         """
+        latest_file = None
+        total = 0
         try:
             # 1. Obtiene lista de extracciones
             extractions = await self.client.get_ftp_extractions()
@@ -281,29 +347,23 @@ class DilveSync:
                     "message": "No extractions available"
                 }
 
+            # 3. Parsea CSV por bloques y los entrega según llegan
             latest_file = files[0]
-            csv_content = await self.client.download_extraction(latest_file)
-
-            if not csv_content:
-                return {
-                    "status": "error",
-                    "message": f"Failed to download {latest_file}"
-                }
-
-            # 3. Parsea CSV
-            records = DilveClient._parse_csv_response(csv_content)
+            async for batch in self.iter_extraction(latest_file):
+                await on_batch(batch)
+                total += len(batch)
 
             return {
                 "status": "success",
-                "records": records,
-                "total": len(records),
+                "total": total,
                 "source": latest_file
             }
 
         except Exception as e:
-            logger.error(f"Error syncing full catalog: {e}")
+            logger.error("Error syncing full catalog after %d records: %s", total, e)
             return {
                 "status": "error",
                 "message": str(e),
-                "records": []
+                "total": total,
+                "source": latest_file
             }
@@ -1,7 +1,21 @@
 import re
 import unicodedata
+from functools import lru_cache
 from typing import List, Dict, Optional
 
+# Patrones compilados una sola vez
+_RE_HEADER_CHARS = re.compile(r'[^a-z0-9_\- ]')
+_RE_UNDERSCORES = re.compile(r'_+')
+
+# Acentos latinos habituales -> ASCII (la cabecera ya viene en minúsculas)
+_ACCENT_TABLE = str.maketrans("áàäâãéèëêíìïîóòöôõúùüûñç", "aaaaaeeeeiiiiooooouuuunc")
+
+def _strip_accents(text: str) -> str:
+    """Quita acentos con NFD; camino lento para caracteres fuera de la tabla"""
+    text = unicodedata.normalize('NFD', text)
+    return "".join([c for c in text if unicodedata.category(c) != 'Mn'])
+
+@lru_cache(maxsize=4096)
 def normalize_header(header: str) -> str:
     """
     Normaliza una cabecera: minúsculas, sin acentos, sin espacios extras ni caracteres raros.
@@ -13,63 +27,71 @@ def normalize_header(header: str) -> str:
     text = header.lower().strip()
     
     # Quitar acentos
-    text = unicodedata.normalize('NFD', text)
-    text = "".join([c for c in text if unicodedata.category(c) != 'Mn'])
+    text = text.translate(_ACCENT_TABLE)
+    if not text.isascii():
+        text = _strip_accents(text)
     
     # Quitar caracteres que no sean letras, números o guiones/guiones bajos
-    text = re.sub(r'[^a-z0-9_\- ]', '', text)
+    text = _RE_HEADER_CHARS.sub('', text)
     
     # Reemplazar espacios por guiones bajos
     text = text.replace(' ', '_')
     
     # Colapsar guiones bajos múltiples
-    text = re.sub(r'_+', '_', text)
+    text = _RE_UNDERSCORES.sub('_', text)
     
     return text.strip('_')
 
+# Sinónimos para heurística
+SYNONYMS = {
+    'isbn13': ['isbn', 'isbn13', 'ean', 'ean13', 'codigo_barras', 'barcode', 'ean_13'],
+    'sku': ['sku', 'referencia', 'ref', 'cod', 'codigo', 'id_producto', 'identificador'],
+    'post_title': ['titulo', 'title', 'nombre', 'denominacion', 'nombre_libro', 'obra'],
+    'author': ['autor', 'autores', 'writer', 'creador', 'firma', 'author', 'escritor'],
+    'publisher': ['editorial', 'publisher', 'editor', 'sello'],
+    'regular_price': ['pvp', 'precio', 'precio_venta', 'price', 'coste', 'venta'],
+    'stock': ['stock', 'existencias', 'unidades', 'cantidad', 'disponibles', 'count', 'qty'],
+    'post_content': ['descripcion', 'resumen', 'contenido', 'sinopsis', 'texto', 'description'],
+    'image_url': ['imagen', 'portada', 'url_imagen', 'image', 'picture', 'foto', 'img_url'],
+    'category_main': ['categoria', 'materia', 'tema', 'genre', 'genero', 'seccion'],
+}
+
+_FIELD_SYNONYMS = {field: tuple(syns) for field, syns in SYNONYMS.items()}
+
+# Índice invertido sinónimo -> (campo, prioridad); el nombre del campo va primero (-1)
+_SYNONYM_INDEX = {}
+for _field, _syns in _FIELD_SYNONYMS.items():
+    for _rank, _syn in enumerate(_syns):
+        _SYNONYM_INDEX.setdefault(_syn, (_field, _rank))
+for _field in _FIELD_SYNONYMS:
+    _SYNONYM_INDEX[_field] = (_field, -1)
+
 def suggest_mapping(headers: List[str]) -> Dict[str, str]:
     """
     Sugiere un mapeo campo_kusidilve -> header_original_del_usuario.
     """
-    # Sinónimos para heurística
-    synonyms = {
-        'isbn13': ['isbn', 'isbn13', 'ean', 'ean13', 'codigo_barras', 'barcode', 'ean_13'],
-        'sku': ['sku', 'referencia', 'ref', 'cod', 'codigo', 'id_producto', 'identificador'],
-        'post_title': ['titulo', 'title', 'nombre', 'denominacion', 'nombre_libro', 'obra'],
-        'author': ['autor', 'autores', 'writer', 'creador', 'firma', 'author', 'escritor'],
-        'publisher': ['editorial', 'publisher', 'editor', 'sello'],
-        'regular_price': ['pvp', 'precio', 'precio_venta', 'price', 'coste', 'venta'],
-        'stock': ['stock', 'existencias', 'unidades', 'cantidad', 'disponibles', 'count', 'qty'],
-        'post_content': ['descripcion', 'resumen', 'contenido', 'sinopsis', 'texto', 'description'],
-        'image_url': ['imagen', 'portada', 'url_imagen', 'image', 'picture', 'foto', 'img_url'],
-        'category_main': ['categoria', 'materia', 'tema', 'genre', 'genero', 'seccion'],
-    }
-
-    mapping = {}
     normalized_headers = {normalize_header(h): h for h in headers}
 
-    for kusi_field, synonym_list in synonyms.items():
-        # Intento 1: Match exacto con el nombre del campo Kusi
-        if kusi_field in normalized_headers:
-            mapping[kusi_field] = normalized_headers[kusi_field]
-            continue
-            
-        # Intento 2: Match con sinónimos
-        found = False
-        for syn in synonym_list:
-            if syn in normalized_headers:
-                mapping[kusi_field] = normalized_headers[syn]
-                found = True
-                break
-        
-        # Intento 3: Contiene substring (más agresivo)
-        if not found:
-            for syn in synonym_list:
-                for norm_h, original_h in normalized_headers.items():
-                    if syn in norm_h:
-                        mapping[kusi_field] = original_h
-                        found = True
-                        break
-                if found: break
+    # Intento 1 y 2: match exacto con el campo Kusi o un sinónimo (O(1) por cabecera)
+    best = {}
+    for norm_h, original_h in normalized_headers.items():
+        hit = _SYNONYM_INDEX.get(norm_h)
+        if hit is not None:
+            field, rank = hit
+            if field not in best or rank < best[field][0]:
+                best[field] = (rank, original_h)
+
+    mapping = {field: hit[1] for field, hit in best.items()}
+
+    # Intento 3: Contiene substring (más agresivo), una pasada por cabecera
+    # solo sobre los campos aún sin mapear
+    unmapped = [field for field in _FIELD_SYNONYMS if field not in mapping]
+    for norm_h, original_h in normalized_headers.items():
+        if not unmapped:
+            break
+        for kusi_field in unmapped:
+            if any(syn in norm_h for syn in _FIELD_SYNONYMS[kusi_field]):
+                mapping[kusi_field] = original_h
+        unmapped = [field for field in unmapped if field not in mapping]
 
     return mapping
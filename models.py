@@ -1,7 +1,7 @@
 """
 Pydantic models for KusiDilve SaaS
 """
-from pydantic import BaseModel, EmailStr, Field
+from pydantic import BaseModel, ConfigDict, EmailStr, Field
 from typing import Optional, List, Dict
 from datetime import datetime
 from enum import Enum
@@ -35,8 +35,7 @@ class BookResponse(BookClean):
     id: int
     library_id: int
 
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
 
 
 class LibraryBase(BaseModel):
@@ -68,8 +67,7 @@ class LibraryResponse(BaseModel):
     created_at: datetime
     last_sync: Optional[datetime] = None
 
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
 
 
 class DashboardMetrics(BaseModel):
@@ -171,8 +169,7 @@ class KusiBook(BaseModel):
     score_seo: int = 0
     is_ai_generated: bool = False
 
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
 
 
 class CSVMappingUpdate(BaseModel):
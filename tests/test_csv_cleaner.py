@@ -1,6 +1,8 @@
 import unittest
-from unittest.mock import patch, MagicMock
+from unittest.mock import MagicMock
+import os
 import sys
+import tempfile
 
 # Mock slugify before importing CSVCleaner because it imports it at module level
 sys.modules['slugify'] = MagicMock()
@@ -12,6 +14,8 @@ class TestCSVCleaner(unittest.TestCase):
         self.assertEqual(CSVCleaner.strip_html_tags("<p>Hello</p>"), "Hello")
         self.assertEqual(CSVCleaner.strip_html_tags("<b>Bold</b> Text"), "Bold Text")
         self.assertEqual(CSVCleaner.strip_html_tags("No Tags"), "No Tags")
+        self.assertEqual(CSVCleaner.strip_html_tags("Hola<script>var a</script>"), "Hola")
+        self.assertEqual(CSVCleaner.strip_html_tags("<!-- vacío -->"), "")
 
     def test_fix_utf8_encoding(self):
         """Test UTF-8 fixing"""
@@ -19,6 +23,8 @@ class TestCSVCleaner(unittest.TestCase):
         self.assertEqual(CSVCleaner.fix_utf8_encoding("Camion"), "Camion") # No change
         # Not easily reproducible without exact broken string bytes, but testing basic passthrough
         self.assertEqual(CSVCleaner.fix_utf8_encoding(""), "")
+        self.assertEqual(CSVCleaner.fix_utf8_encoding("TÃ­tulo con ñ"), "Título con ñ")
+        self.assertEqual(CSVCleaner.fix_utf8_encoding("Descripción"), "Descripción")
 
     def test_clean_description(self):
         """Test description cleaning and truncating"""
@@ -34,15 +40,11 @@ class TestCSVCleaner(unittest.TestCase):
         self.assertEqual(CSVCleaner.generate_seo_title(title, author), "El Quijote | Cervantes")
         self.assertEqual(CSVCleaner.generate_seo_title(title), "El Quijote")
 
-    @patch('csv_cleaner.slugify')
-    def test_generate_slug(self, mock_slugify):
+    def test_generate_slug(self):
         """Test slug generation"""
-        # Configure mock
-        mock_slugify.side_effect = lambda x, max_length=100: x.lower().replace(" ", "-").replace("&", "")
-        
         self.assertEqual(CSVCleaner.generate_slug("El Quijote", "Cervantes"), "el-quijote-cervantes")
-        # Note: simplistic mock implementation for the test
-        self.assertEqual(CSVCleaner.generate_slug("Cafe & Libros"), "cafe--libros")
+        self.assertEqual(CSVCleaner.generate_slug("Cafe & Libros"), "cafe-libros")
+        self.assertEqual(CSVCleaner.generate_slug("Niño ¿Qué?", "José María"), "nino-que-jose-maria")
 
     def test_clean_row_completa(self):
         """Test full row cleaning integration"""
@@ -65,5 +67,54 @@ class TestCSVCleaner(unittest.TestCase):
         self.assertEqual(cleaned['categories'], "Ficción Clásica") # Verified integration with thema_utils
         self.assertTrue(cleaned['score_seo'] > 0)
 
+    def test_process_upload(self):
+        """Test upload parsing with saved and suggested mappings"""
+        content = "ISBN,Título,Stock\n9781234567890,Libro,3\n".encode('utf-8')
+
+        parsed = CSVCleaner.process_upload(content, {"isbn13": "ISBN", "title": "Título", "stock": "Stock"})
+        self.assertEqual(parsed['headers'], ["ISBN", "Título", "Stock"])
+        self.assertEqual(parsed['processed'], 1)
+        self.assertEqual(parsed['errors'], 0)
+        self.assertEqual(parsed['cleaned_rows'][0]['isbn13'], "9781234567890")
+        self.assertEqual(parsed['cleaned_rows'][0]['title'], "Libro")
+        self.assertEqual(parsed['cleaned_rows'][0]['stock'], 3)
+
+        suggested = CSVCleaner.process_upload(content)
+        self.assertEqual(suggested['mapping'].get("isbn13"), "ISBN")
+
+        self.assertIsNone(CSVCleaner.process_upload(b"")['headers'])
+
+    def test_process_upload_ragged_rows(self):
+        """Test extra and missing fields do not shift columns or fail the upload"""
+        content = (
+            "ISBN,Título,Stock\n"
+            "9781234567890,Libro,con coma,3\n"
+            "9781234567891,Otro\n"
+            "9781234567892,Tercero,5,extra\n"
+        ).encode('utf-8')
+
+        parsed = CSVCleaner.process_upload(content, {"isbn13": "ISBN", "title": "Título", "stock": "Stock"})
+        self.assertEqual(parsed['processed'], 3)
+        self.assertEqual(parsed['errors'], 0)
+        rows = parsed['cleaned_rows']
+        self.assertEqual([r['isbn13'] for r in rows], ["9781234567890", "9781234567891", "9781234567892"])
+        self.assertEqual(rows[0]['title'], "Libro")
+        self.assertEqual(rows[1]['stock'], 0)
+        self.assertEqual(rows[2]['stock'], 5)
+
+    def test_clean_csv_to_jsonl(self):
+        """Test JSONL cache of cleaned rows feeding the WooCommerce export"""
+        rows = [{"isbn13": "9781234567890", "titulo": "Libro", "precio": "10,50", "stock": "2"}]
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "cleaned.jsonl")
+            self.assertEqual(CSVCleaner.clean_csv_to_jsonl(rows, path), (1, 0))
+
+            cached = list(CSVCleaner.read_jsonl(path))
+            self.assertEqual(cached, CSVCleaner.clean_csv(rows)[0])
+            self.assertEqual(
+                CSVCleaner.to_woocommerce_csv(CSVCleaner.read_jsonl(path)),
+                CSVCleaner.to_woocommerce_csv(cached)
+            )
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,56 @@
+import csv
+import os
+import tempfile
+import unittest
+from unittest.mock import MagicMock
+import sys
+
+# Mock slugify before importing CSVCleaner because it imports it at module level
+sys.modules['slugify'] = MagicMock()
+from csv_wpallimport import WPAllImportConverter
+
+HEADER = "isbn13;titulo;autor;descripcion;precio;stock\n"
+
+
+class TestWPAllImportConverter(unittest.TestCase):
+    def _convert(self, body: str):
+        with tempfile.TemporaryDirectory() as tmp:
+            src = os.path.join(tmp, "dilve.csv")
+            out = os.path.join(tmp, "wp.csv")
+            with open(src, "w", encoding="utf-8") as f:
+                f.write(HEADER + body)
+            result = WPAllImportConverter.process_dilve_csv(src, out)
+            with open(out, newline="", encoding="utf-8") as f:
+                rows = list(csv.DictReader(f))
+        return result, rows
+
+    def test_extra_field_in_first_row_does_not_shift_columns(self):
+        """Test a 7-field first row is truncated instead of becoming the index"""
+        result, rows = self._convert(
+            "9788496479685;Libro;Autor;Desc;18,95;5;sobra\n"
+            "9788496479686;Otro;Otro Autor;Desc;22,50;0\n"
+        )
+        self.assertEqual(result['status'], 'success')
+        self.assertEqual(result['total'], 2)
+        self.assertEqual(result['errors'], 0)
+        self.assertEqual(result['truncated'], 1)
+        self.assertEqual(rows[0]['_id'], '9788496479685')
+        self.assertEqual(rows[0]['post_title'], 'Libro | Autor')
+        self.assertEqual(rows[0]['_stock'], '5')
+        self.assertEqual(rows[1]['_id'], '9788496479686')
+        self.assertEqual(rows[1]['_stock'], '0')
+
+    def test_extra_field_in_later_row_is_kept_and_reported(self):
+        """Test a later row with an extra delimiter is converted and counted as truncated"""
+        result, rows = self._convert(
+            "9788496479685;Libro;Autor;Desc;18,95;5\n"
+            "9788496479686;Otro;Otro Autor;Desc;22,50;3;sobra\n"
+        )
+        self.assertEqual(result['total'], 2)
+        self.assertEqual(result['errors'], 0)
+        self.assertEqual(result['truncated'], 1)
+        self.assertEqual([r['_id'] for r in rows], ['9788496479685', '9788496479686'])
+        self.assertEqual(rows[1]['_stock'], '3')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,37 @@
+import unittest
+from sqlalchemy import create_engine, inspect
+from sqlalchemy.orm import Session
+from database import Base, Book, Library, bulk_upsert_books, ensure_book_indexes
+
+class TestBookUpsert(unittest.TestCase):
+    def setUp(self):
+        # Tabla books como la dejaba el esquema anterior: sin los índices compuestos
+        self.engine = create_engine("sqlite://")
+        Base.metadata.create_all(bind=self.engine)
+        with self.engine.begin() as conn:
+            for name in ("ix_book_library_isbn", "ix_book_library_dirty", "ix_book_library_stats"):
+                conn.exec_driver_sql(f"DROP INDEX {name}")
+
+    def test_upsert_on_existing_database(self):
+        """Duplicates are removed and the upsert works after migrating an old table"""
+        with Session(self.engine) as session:
+            session.add(Library(id=1, name="Kusi"))
+            session.add_all([
+                Book(library_id=1, isbn13="9788400000001", title="Antiguo"),
+                Book(library_id=1, isbn13="9788400000001", title="Reciente"),
+            ])
+            session.commit()
+
+        with self.engine.begin() as conn:
+            self.assertEqual(ensure_book_indexes(conn), 1)
+            indexes = {index["name"] for index in inspect(conn).get_indexes("books")}
+        self.assertIn("ix_book_library_isbn", indexes)
+
+        with Session(self.engine) as session:
+            bulk_upsert_books(session, [{"library_id": 1, "isbn13": "9788400000001", "title": "Nuevo"}])
+            session.commit()
+            titles = [book.title for book in session.query(Book).all()]
+        self.assertEqual(titles, ["Nuevo"])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,5 +1,5 @@
 import unittest
-from thema_utils import map_thema_to_kusi
+from thema_utils import map_thema_batch, map_thema_to_kusi
 
 class TestThemaUtils(unittest.TestCase):
     def test_map_thema_exact_match(self):
@@ -27,5 +27,10 @@ class TestThemaUtils(unittest.TestCase):
         self.assertEqual(map_thema_to_kusi("fb"), "Ficción Clásica")
         self.assertEqual(map_thema_to_kusi("f"), "Ficción")
 
+    def test_map_thema_batch(self):
+        """Test batch mapping keeps row order and matches single lookups"""
+        codes = ["FB", "fba", "", "ZZZ", "FB"]
+        self.assertEqual(map_thema_batch(codes), [map_thema_to_kusi(c) for c in codes])
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,7 +1,8 @@
 """
 Thema Utils - Mapeo de códigos Thema a categorías Kusi
 """
-from typing import Dict
+from functools import lru_cache
+from typing import Dict, List
 
 # Mapeo simplificado de códigos Thema a categorías legibles
 # Referencia: https://www.editeur.org/151/Thema/
@@ -40,23 +41,54 @@ THEMA_MAPPING: Dict[str, str] = {
     "W": "Estilo de Vida, Deporte y Ocio",
 }
 
+# Trie de prefijos de THEMA_MAPPING: {carácter: nodo}, categoría en la clave "_v"
+_THEMA_TRIE: Dict[str, dict] = {}
+for _code, _category in THEMA_MAPPING.items():
+    _node = _THEMA_TRIE
+    for _char in _code:
+        _node = _node.setdefault(_char, {})
+    _node["_v"] = _category
+
 def map_thema_to_kusi(thema_code: str) -> str:
     """
     Mapea un código Thema (o prefijo) a una categoría Kusi.
     """
     if not thema_code:
         return "Sin Categoría"
-    
-    code = str(thema_code).strip().upper()
-    
+
+    # Camino rápido: el código ya viene canónico (str ASCII en mayúsculas, sin espacios)
+    if (
+        type(thema_code) is str
+        and thema_code.isascii()
+        and thema_code.isupper()
+        and not thema_code[0].isspace()
+        and not thema_code[-1].isspace()
+    ):
+        return _lookup_thema(thema_code)
+
+    return _lookup_thema(str(thema_code).strip().upper())
+
+def map_thema_batch(codes: List[str]) -> List[str]:
+    """
+    Mapea una columna de códigos Thema: una búsqueda por valor distinto, no por fila.
+    """
+    categories = {code: map_thema_to_kusi(code) for code in set(codes)}
+    return [categories[code] for code in codes]
+
+@lru_cache(maxsize=4096)
+def _lookup_thema(code: str) -> str:
+    """Categoría de un código ya normalizado (mayúsculas, sin espacios)"""
     # Intento 1: Match exacto
     if code in THEMA_MAPPING:
         return THEMA_MAPPING[code]
-    
-    # Intento 2: Match por prefijo (ej: FB -> F, JAB -> JA)
-    for length in range(len(code) - 1, 0, -1):
-        prefix = code[:length]
-        if prefix in THEMA_MAPPING:
-            return THEMA_MAPPING[prefix]
-            
-    return "Otros"
+
+    # Intento 2: Prefijo más largo (ej: FBA -> FB, JAB -> JA), recorriendo el trie
+    node = _THEMA_TRIE
+    best = "Otros"
+    for char in code:
+        node = node.get(char)
+        if node is None:
+            break
+        best = node.get("_v", best)
+
+    return best
@@ -1,14 +1,50 @@
 """
 WooCommerce Sync - Gestor de sincronización de stock
 """
+import asyncio
+from collections import Counter
 import httpx
 import logging
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Tuple
 from base64 import b64encode
-import json
+import orjson
+from cachetools import TTLCache
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential
 
 logger = logging.getLogger(__name__)
 
+# Cuerpos serializados con orjson (en vez de json= de httpx)
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+# Estados transitorios en los que la tienda no procesó la petición
+# (sin 500/504: un POST podría haberse aplicado y el reintento duplicaría productos)
+RETRY_STATUSES = {429, 502, 503}
+_backoff = wait_exponential(multiplier=0.2, max=2)
+
+
+def _is_retryable(exc: BaseException) -> bool:
+    if isinstance(exc, httpx.HTTPStatusError):
+        return exc.response.status_code in RETRY_STATUSES
+    # Errores al conectar: la petición no llegó al servidor
+    return isinstance(exc, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout))
+
+
+def _retry_wait(retry_state) -> float:
+    """Espera exponencial; en 429 respeta Retry-After (máx. 30 s)"""
+    exc = retry_state.outcome.exception()
+    if isinstance(exc, httpx.HTTPStatusError) and exc.response.status_code == 429:
+        retry_after = exc.response.headers.get("Retry-After", "")
+        if retry_after.isdigit():
+            return min(float(retry_after), 30.0)
+    return _backoff(retry_state)
+
+
+# Máximo de SKUs por consulta /products?sku=a,b,c (per_page de WooCommerce)
+SKU_BATCH_SIZE = 100
+
+# Máximo de operaciones por petición a /products/batch
+WRITE_BATCH_SIZE = 100
+
 
 class WooCommerceClient:
     """Cliente para API REST WooCommerce"""
@@ -25,30 +61,64 @@ class WooCommerceClient:
         self.consumer_secret = consumer_secret
         self.api_url = f"{self.store_url}/wp-json/wc/v3"
         self.timeout = 30
+        self._auth_header = None
+        # Búsquedas por SKU en curso o recientes: {sku: Task}
+        self._sku_cache = TTLCache(maxsize=4096, ttl=60)
+        # Cliente compartido: mantiene conexiones keep-alive entre peticiones,
+        # con la autenticación como cabecera por defecto
+        self._client = httpx.AsyncClient(
+            base_url=self.api_url,
+            headers=self._get_auth_header(),
+            timeout=self.timeout,
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+            http2=True  # multiplexa las peticiones concurrentes en una conexión TLS
+        )
+
+    async def aclose(self):
+        """Cierra el pool de conexiones HTTP"""
+        await self._client.aclose()
+
+    @retry(
+        retry=retry_if_exception(_is_retryable),
+        stop=stop_after_attempt(3),
+        wait=_retry_wait,
+        reraise=True
+    )
+    async def _send(self, method: str, url: str, **kwargs) -> httpx.Response:
+        """Petición por el cliente compartido; lanza HTTPStatusError si no es 2xx (con reintentos)"""
+        response = await self._client.request(method, url, **kwargs)
+        if not response.is_success:
+            response.raise_for_status()
+        return response
+
+    async def __aenter__(self) -> "WooCommerceClient":
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.aclose()
 
     def _get_auth_header(self) -> Dict:
-        """Genera header de autenticación Basic Auth"""
-        credentials = f"{self.consumer_key}:{self.consumer_secret}"
-        encoded = b64encode(credentials.encode()).decode()
-        return {"Authorization": f"Basic {encoded}"}
+        """Header de autenticación Basic Auth (codificado una sola vez por cliente)"""
+        if self._auth_header is None:
+            credentials = f"{self.consumer_key}:{self.consumer_secret}"
+            encoded = b64encode(credentials.encode()).decode()
+            self._auth_header = {"Authorization": f"Basic {encoded}"}
+        return dict(self._auth_header)
 
     async def test_connection(self) -> Dict:
         """
         Prueba conexión a WooCommerce
         """
         try:
-            url = f"{self.api_url}/products?per_page=1"
-            headers = self._get_auth_header()
+            url = "/products?per_page=1"
 
-            async with httpx.AsyncClient(timeout=self.timeout) as client:
-                response = await client.get(url, headers=headers)
-                response.raise_for_status()
+            await self._send("GET", url)
 
-                logger.info("WooCommerce connection successful")
-                return {
-                    "status": "success",
-                    "message": "Conexión exitosa a WooCommerce"
-                }
+            logger.info("WooCommerce connection successful")
+            return {
+                "status": "success",
+                "message": "Conexión exitosa a WooCommerce"
+            }
 
         except Exception as e:
             logger.error(f"WooCommerce connection error: {e}")
@@ -60,58 +130,122 @@ class WooCommerceClient:
     async def get_product_by_sku(self, sku: str) -> Optional[Dict]:
         """
         Obtiene producto por SKU
+        Comparte la petición entre llamadas concurrentes y la recuerda 60 s (no los errores)
         """
-        try:
-            url = f"{self.api_url}/products"
-            params = {"sku": sku}
-            headers = self._get_auth_header()
-
-            async with httpx.AsyncClient(timeout=self.timeout) as client:
-                response = await client.get(url, params=params, headers=headers)
-                response.raise_for_status()
-
-                products = response.json()
-                if products:
-                    return products[0]
-                return None
+        task = self._sku_cache.get(sku)
+        if task is None:
+            task = self._sku_cache[sku] = asyncio.ensure_future(self._fetch_product_by_sku(sku))
 
+        try:
+            return await asyncio.shield(task)
         except Exception as e:
+            self._sku_cache.pop(sku, None)
             logger.error(f"Error getting product by SKU {sku}: {e}")
             return None
 
+    async def _fetch_product_by_sku(self, sku: str) -> Optional[Dict]:
+        response = await self._send("GET", "/products", params={"sku": sku})
+
+        products = orjson.loads(response.content)
+        if products:
+            return products[0]
+        return None
+
+    async def get_products_by_skus(self, skus: List[str], concurrency: int = 5) -> Dict[str, Dict]:
+        """
+        Obtiene productos existentes por SKU en lotes de 100 (filtro sku separado por comas)
+        Lanza la excepción HTTP si falla un lote: sin el mapa completo se duplicarían productos
+
+        Returns:
+            {sku: producto}
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def fetch_chunk(chunk: List[str]) -> List[Dict]:
+            async with semaphore:
+                response = await self._send(
+                    "GET", "/products",
+                    params={"sku": ",".join(chunk), "per_page": SKU_BATCH_SIZE}
+                )
+                return orjson.loads(response.content)
+
+        unique_skus = list(dict.fromkeys(sku for sku in skus if sku))
+        pages = await asyncio.gather(*(
+            fetch_chunk(unique_skus[i:i + SKU_BATCH_SIZE])
+            for i in range(0, len(unique_skus), SKU_BATCH_SIZE)
+        ))
+        return {product["sku"]: product for page in pages for product in page}
+
+    @staticmethod
+    def update_payload(product_data: Dict, product_id: Optional[int] = None) -> Dict:
+        """Cuerpo de actualización de producto (con `id` para /products/batch)"""
+        get = product_data.get
+        description = get("description_clean")
+        payload = {
+            "name": get("title"),
+            "description": description,
+            "short_description": (description or "")[:155],
+            "regular_price": str(get("price", 0)),
+            "stock_quantity": get("stock", 0),
+            "stock_status": get("stock_status", "out_of_stock"),
+        }
+        if product_id is not None:
+            payload["id"] = product_id
+        return payload
+
+    @staticmethod
+    def create_payload(product_data: Dict) -> Dict:
+        """Cuerpo de alta de producto: el de actualización más SKU, categoría y metadatos"""
+        get = product_data.get
+        payload = WooCommerceClient.update_payload(product_data)
+        payload["sku"] = get("sku")
+        payload["manage_stock"] = True
+        payload["categories"] = [{"name": get("categories", "Ficción")}]
+        payload["meta_data"] = [
+            {"key": "isbn13", "value": get("isbn13")},
+            {"key": "author", "value": get("author", "")},
+            {"key": "seo_score", "value": str(get("score_seo", 0))}
+        ]
+        return payload
+
+    async def batch_products(
+        self,
+        create: Optional[List[Dict]] = None,
+        update: Optional[List[Dict]] = None
+    ) -> Dict:
+        """
+        POST /products/batch - altas y actualizaciones en una sola petición
+        WooCommerce admite hasta 100 operaciones por petición: el llamador trocea
+
+        Returns:
+            {"create": [...], "update": [...]} (cada elemento es el producto o {"error": ...})
+        """
+        payload = {}
+        if create:
+            payload["create"] = create
+        if update:
+            payload["update"] = update
+
+        response = await self._send(
+            "POST", "/products/batch", content=orjson.dumps(payload), headers=JSON_HEADERS
+        )
+        return orjson.loads(response.content)
+
     async def create_product(self, product_data: Dict) -> Optional[Dict]:
         """
         Crea nuevo producto en WooCommerce
         """
         try:
-            url = f"{self.api_url}/products"
-            headers = self._get_auth_header()
-            headers["Content-Type"] = "application/json"
+            url = "/products"
 
-            payload = {
-                "name": product_data.get("title"),
-                "sku": product_data.get("sku"),
-                "description": product_data.get("description_clean"),
-                "short_description": product_data.get("description_clean", "")[:155],
-                "regular_price": str(product_data.get("price", 0)),
-                "stock_quantity": product_data.get("stock", 0),
-                "stock_status": product_data.get("stock_status", "out_of_stock"),
-                "manage_stock": True,
-                "categories": [{"name": product_data.get("categories", "Ficción")}],
-                "meta_data": [
-                    {"key": "isbn13", "value": product_data.get("isbn13")},
-                    {"key": "author", "value": product_data.get("author", "")},
-                    {"key": "seo_score", "value": str(product_data.get("score_seo", 0))}
-                ]
-            }
+            payload = self.create_payload(product_data)
 
-            async with httpx.AsyncClient(timeout=self.timeout) as client:
-                response = await client.post(url, json=payload, headers=headers)
-                response.raise_for_status()
+            response = await self._send("POST", url, content=orjson.dumps(payload), headers=JSON_HEADERS)
 
-                product = response.json()
-                logger.info(f"Product created: {product.get('id')} - {product.get('name')}")
-                return product
+            product = orjson.loads(response.content)
+            self._sku_cache.pop(product_data.get("sku"), None)
+            logger.info(f"Product created: {product.get('id')} - {product.get('name')}")
+            return product
 
         except Exception as e:
             logger.error(f"Error creating product: {e}")
@@ -122,26 +256,15 @@ class WooCommerceClient:
         Actualiza producto existente
         """
         try:
-            url = f"{self.api_url}/products/{product_id}"
-            headers = self._get_auth_header()
-            headers["Content-Type"] = "application/json"
+            url = f"/products/{product_id}"
 
-            payload = {
-                "name": product_data.get("title"),
-                "description": product_data.get("description_clean"),
-                "short_description": product_data.get("description_clean", "")[:155],
-                "regular_price": str(product_data.get("price", 0)),
-                "stock_quantity": product_data.get("stock", 0),
-                "stock_status": product_data.get("stock_status", "out_of_stock"),
-            }
+            payload = self.update_payload(product_data)
 
-            async with httpx.AsyncClient(timeout=self.timeout) as client:
-                response = await client.put(url, json=payload, headers=headers)
-                response.raise_for_status()
+            response = await self._send("PUT", url, content=orjson.dumps(payload), headers=JSON_HEADERS)
 
-                product = response.json()
-                logger.info(f"Product updated: {product_id}")
-                return product
+            product = orjson.loads(response.content)
+            logger.info(f"Product updated: {product_id}")
+            return product
 
         except Exception as e:
             logger.error(f"Error updating product {product_id}: {e}")
@@ -152,9 +275,7 @@ class WooCommerceClient:
         Actualiza stock de producto
         """
         try:
-            url = f"{self.api_url}/products/{product_id}"
-            headers = self._get_auth_header()
-            headers["Content-Type"] = "application/json"
+            url = f"/products/{product_id}"
 
             payload = {
                 "stock_quantity": stock,
@@ -163,13 +284,11 @@ class WooCommerceClient:
             if status:
                 payload["stock_status"] = status
 
-            async with httpx.AsyncClient(timeout=self.timeout) as client:
-                response = await client.put(url, json=payload, headers=headers)
-                response.raise_for_status()
+            response = await self._send("PUT", url, content=orjson.dumps(payload), headers=JSON_HEADERS)
 
-                product = response.json()
-                logger.info(f"Stock updated: {product_id} -> {stock}")
-                return product
+            product = orjson.loads(response.content)
+            logger.info(f"Stock updated: {product_id} -> {stock}")
+            return product
 
         except Exception as e:
             logger.error(f"Error updating stock for {product_id}: {e}")
@@ -180,49 +299,57 @@ class WooCommerceClient:
         Oculta producto sin stock
         """
         try:
-            url = f"{self.api_url}/products/{product_id}"
-            headers = self._get_auth_header()
-            headers["Content-Type"] = "application/json"
+            url = f"/products/{product_id}"
 
             payload = {
                 "status": "draft",  # Oculta del catálogo
                 "stock_status": "out_of_stock"
             }
 
-            async with httpx.AsyncClient(timeout=self.timeout) as client:
-                response = await client.put(url, json=payload, headers=headers)
-                response.raise_for_status()
+            response = await self._send("PUT", url, content=orjson.dumps(payload), headers=JSON_HEADERS)
 
-                logger.info(f"Product hidden: {product_id}")
-                return response.json()
+            logger.info(f"Product hidden: {product_id}")
+            return orjson.loads(response.content)
 
         except Exception as e:
             logger.error(f"Error hiding product {product_id}: {e}")
             return None
 
-    async def get_all_products(self, per_page: int = 100) -> List[Dict]:
+    async def get_all_products(self, per_page: int = 100, concurrency: int = 5) -> List[Dict]:
         """
-        Obtiene todos los productos (paginado)
+        Obtiene todos los productos (paginado, orden estable por id)
+        La primera página da X-WP-TotalPages; el resto se pide en paralelo
+        Sin esa cabecera, pagina en secuencia hasta una página incompleta
         """
         try:
-            all_products = []
-            page = 1
-
-            while True:
-                url = f"{self.api_url}/products"
-                params = {"per_page": per_page, "page": page}
-                headers = self._get_auth_header()
-
-                async with httpx.AsyncClient(timeout=self.timeout) as client:
-                    response = await client.get(url, params=params, headers=headers)
-                    response.raise_for_status()
+            async def fetch_page(page: int) -> httpx.Response:
+                return await self._send("GET", "/products", params={
+                    "per_page": per_page, "page": page, "orderby": "id", "order": "asc"
+                })
+
+            response = await fetch_page(1)
+            all_products = orjson.loads(response.content)
+            total_pages = response.headers.get("X-WP-TotalPages")
+
+            if total_pages is None:
+                page = 1
+                products = all_products
+                while len(products) == per_page:
+                    page += 1
+                    products = orjson.loads((await fetch_page(page)).content)
+                    all_products.extend(products)
+            else:
+                semaphore = asyncio.Semaphore(concurrency)
 
-                    products = response.json()
-                    if not products:
-                        break
+                async def fetch_bounded(page: int) -> List[Dict]:
+                    async with semaphore:
+                        return orjson.loads((await fetch_page(page)).content)
 
+                pages = await asyncio.gather(*(
+                    fetch_bounded(page) for page in range(2, int(total_pages) + 1)
+                ))
+                for products in pages:
                     all_products.extend(products)
-                    page += 1
 
             logger.info(f"Retrieved {len(all_products)} products from WooCommerce")
             return all_products
@@ -238,9 +365,10 @@ class WooCommerceSync:
     def __init__(self, wc_client: WooCommerceClient):
         self.wc = wc_client
 
-    async def sync_products(self, cleaned_books: List[Dict]) -> Dict:
+    async def sync_products(self, cleaned_books: List[Dict], concurrency: int = 5) -> Dict:
         """
         Sincroniza libros limpios a WooCommerce
+        Envía altas y actualizaciones por /products/batch, hasta `concurrency` lotes en paralelo
         
         Returns:
             {
@@ -251,33 +379,29 @@ class WooCommerceSync:
                 "total": 17
             }
         """
-        created = 0
-        updated = 0
-        errors = 0
-
-        for book in cleaned_books:
-            try:
-                # Busca producto existente por SKU
-                existing = await self.wc.get_product_by_sku(book["sku"])
-
-                if existing:
-                    # Actualiza
-                    result = await self.wc.update_product(existing["id"], book)
-                    if result:
-                        updated += 1
-                    else:
-                        errors += 1
-                else:
-                    # Crea nuevo
-                    result = await self.wc.create_product(book)
-                    if result:
-                        created += 1
-                    else:
-                        errors += 1
+        # Un producto por SKU (derivado del ISBN, puede repetirse): gana el último libro
+        books_by_sku = {book["sku"]: book for book in cleaned_books}
+
+        # Productos existentes en ⌈N/100⌉ consultas en vez de una por libro
+        try:
+            existing_by_sku = await self.wc.get_products_by_skus(list(books_by_sku))
+        except Exception as e:
+            logger.error(f"Error looking up existing products: {e}")
+            return {
+                "status": "error",
+                "message": str(e)
+            }
+
+        to_create = []
+        to_update = []
+        for sku, book in books_by_sku.items():
+            existing = existing_by_sku.get(sku)
+            if existing:
+                to_update.append(WooCommerceClient.update_payload(book, existing["id"]))
+            else:
+                to_create.append(WooCommerceClient.create_payload(book))
 
-            except Exception as e:
-                logger.error(f"Error syncing product {book.get('sku')}: {e}")
-                errors += 1
+        created, updated, errors = await self._run_batches(to_create, to_update, concurrency)
 
         return {
             "status": "success" if errors == 0 else "partial",
@@ -287,22 +411,61 @@ class WooCommerceSync:
             "total": len(cleaned_books)
         }
 
-    async def hide_out_of_stock_products(self) -> Dict:
+    async def _run_batches(
+        self,
+        to_create: List[Dict],
+        to_update: List[Dict],
+        concurrency: int
+    ) -> Tuple[int, int, int]:
+        """
+        Envía altas y actualizaciones a /products/batch en lotes de WRITE_BATCH_SIZE
+        Retorna (created, updated, errors)
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def send(kind: str, chunk: List[Dict]) -> Dict:
+            async with semaphore:
+                return await self.wc.batch_products(**{kind: chunk})
+
+        chunks = [
+            (kind, items[i:i + WRITE_BATCH_SIZE])
+            for kind, items in (("create", to_create), ("update", to_update))
+            for i in range(0, len(items), WRITE_BATCH_SIZE)
+        ]
+        results = await asyncio.gather(
+            *(send(kind, chunk) for kind, chunk in chunks),
+            return_exceptions=True
+        )
+
+        tally = Counter()
+
+        for (kind, chunk), result in zip(chunks, results):
+            if isinstance(result, Exception):
+                logger.error(f"Error in WooCommerce batch {kind} ({len(chunk)} products): {result}")
+                tally["error"] += len(chunk)
+                continue
+            for item in result.get(kind, []):
+                if "error" in item:
+                    logger.error(f"WooCommerce batch {kind} item error: {item['error']}")
+                    tally["error"] += 1
+                else:
+                    tally[kind] += 1
+
+        return tally["create"], tally["update"], tally["error"]
+
+    async def hide_out_of_stock_products(self, concurrency: int = 5) -> Dict:
         """
         Oculta todos los productos sin stock
+        Filtra en local y envía los cambios por /products/batch, hasta `concurrency` lotes en paralelo
         """
         try:
             products = await self.wc.get_all_products()
-            hidden = 0
-            errors = 0
-
-            for product in products:
-                if product.get("stock_status") == "out_of_stock":
-                    result = await self.wc.hide_out_of_stock(product["id"])
-                    if result:
-                        hidden += 1
-                    else:
-                        errors += 1
+            targets = [
+                {"id": product["id"], "status": "draft", "stock_status": "out_of_stock"}
+                for product in products
+                if product.get("stock_status") == "out_of_stock"
+            ]
+            _, hidden, errors = await self._run_batches([], targets, concurrency)
 
             return {
                 "status": "success" if errors == 0 else "partial",
@@ -318,30 +481,30 @@ class WooCommerceSync:
                 "message": str(e)
             }
 
-    async def sync_stock_only(self, books: List[Dict]) -> Dict:
+    async def sync_stock_only(self, books: List[Dict], concurrency: int = 5) -> Dict:
         """
         Sincroniza solo stock (sin actualizar otros campos)
+        Envía las actualizaciones por /products/batch, hasta `concurrency` lotes en paralelo
         """
-        updated = 0
-        errors = 0
-
-        for book in books:
-            try:
-                existing = await self.wc.get_product_by_sku(book["sku"])
-                if existing:
-                    result = await self.wc.update_stock(
-                        existing["id"],
-                        book["stock"],
-                        book["stock_status"]
-                    )
-                    if result:
-                        updated += 1
-                    else:
-                        errors += 1
-
-            except Exception as e:
-                logger.error(f"Error updating stock for {book.get('sku')}: {e}")
-                errors += 1
+        try:
+            existing_by_sku = await self.wc.get_products_by_skus([book["sku"] for book in books])
+        except Exception as e:
+            logger.error(f"Error looking up existing products: {e}")
+            return {
+                "status": "error",
+                "message": str(e)
+            }
+
+        to_update = [
+            {
+                "id": existing["id"],
+                "stock_quantity": book["stock"],
+                "stock_status": book["stock_status"]
+            }
+            for book in books
+            if (existing := existing_by_sku.get(book["sku"]))
+        ]
+        _, updated, errors = await self._run_batches([], to_update, concurrency)
 
         return {
             "status": "success" if errors == 0 else "partial",